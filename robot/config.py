@@ -1,8 +1,18 @@
 # tts server parameters
 SERVER_URL = "http://192.168.137.1:8000"  # replace with your windows server ip
 TTS_SPEAKER = "baya"
-TTS_SAMPLE_RATE = 48000
+TTS_SAMPLE_RATE = 44100  # keep equal to AUDIO_FREQUENCY, the server resamples so the mixer does not have to
 TTS_TIMEOUT = 30
+TTS_STREAMING = True  # use /conversation/stream and start speaking after the first sentence
+TTS_BINARY = True  # ask /conversation for raw audio instead of base64 in json
+TTS_FORMAT = "ogg"  # audio codec requested from the server: wav, flac, ogg or opus
+SENTENCE_PAUSE_MS = 150  # silence between streamed sentences, same as the server puts into whole answers
+TTS_WEBSOCKET = True  # keep one websocket to the server instead of a post per utterance
+WS_URL = SERVER_URL.replace("http", "ws", 1) + "/ws"
+WS_CONNECT_TIMEOUT = 5
+WS_HEARTBEAT_INTERVAL = 5  # seconds between pings
+WS_MISSED_HEARTBEATS = 3  # reconnect after this many intervals of silence
+WS_RECONNECT_MAX_DELAY = 10  # maximum backoff between reconnect attempts
 HEALTH_CHECK_TIMEOUT = 5
 
 # stt parameters
@@ -98,6 +108,4 @@ EYE_IMAGES = {
     'pop': 'pop',
     'rolled': 'rolled',
     'sad': 'sad'
-}
-# file paths
-TEMP_AUDIO_FILE = '/tmp/response.wav'
\ No newline at end of file
+}
\ No newline at end of file
@@ -9,9 +9,14 @@ import requests
 import pygame
 import speech_recognition as sr
 import base64
+import io
+import json
 import random
+from urllib.parse import unquote
 from config import *
 from display_overlay import show_image
+if TTS_WEBSOCKET:
+    from ws_client import ConversationChannel
 
 # get robot pid from command line
 robot_pid = None
@@ -38,49 +43,119 @@ class SystemState:
     last_wake_time = 0
     last_command_time = 0
     
-#thread-safe audio player
+# thread-safe audio player. answers are decoded in memory and played on a
+# reserved mixer channel: every sentence is queued behind the one playing as
+# soon as it arrives, so speech starts with the first sentence, there are no
+# gaps between sentences and nothing is written to the sd card. the end of
+# playback is signalled through an event (see wait) instead of polling
 class AudioPlayer:
+    # the channel holds a single queued sound; the next one is handed over
+    # this long after the queued sound has started playing
+    QUEUE_MARGIN = 0.02
+
     def __init__(self):
-        self.playing = False
         self.lock = threading.Lock()
-    #play audio data in background thread
+        pygame.mixer.set_reserved(1)
+        self.channel = pygame.mixer.Channel(0)
+        self.stopped = threading.Event()
+        self.finished = threading.Event()
+        self.finished.set()
+
+    @property
+    def playing(self):
+        return not self.finished.is_set()
+
+#    block until the current playback ends, returns False on timeout
+    def wait(self, timeout=None):
+        return self.finished.wait(timeout)
+
+    #play a complete answer
     def play_audio_from_server(self, audio_data):
-        def playback_thread():
-            with self.lock:
-                self.playing = True
-            try:
-                temp_filename = "/tmp/response.wav"
-                with open(temp_filename, 'wb') as f:
-                    f.write(audio_data)
-                print("playing")
-                pygame.mixer.music.load(temp_filename)
-                pygame.mixer.music.play()
-                while pygame.mixer.music.get_busy():
-                    time.sleep(0.05)
-                try:
-                    os.remove(temp_filename)
-                except:
-                    pass
-                print("playback complete")
-            except Exception as e:
-                print(f"playback error: {e}")
-                show_image('error')
-                time.sleep(1.0)
-                show_image('common')
-            finally:
+        self.play_audio_stream([audio_data])
+
+    #play audio chunks one after another as they arrive from the server,
+    #a new answer interrupts the previous one
+    def play_audio_stream(self, audio_chunks):
+        with self.lock:
+            self.stopped.set()
+            self.channel.stop()
+            self.finished.set()
+            self.stopped = threading.Event()
+            self.finished = threading.Event()
+            stopped, finished = self.stopped, self.finished
+        threading.Thread(
+            target=self._playback,
+            args=(audio_chunks, stopped, finished),
+            daemon=True
+        ).start()
+
+    def _playback(self, audio_chunks, stopped, finished):
+        # monotonic times when everything handed to the channel ends and
+        # when its queue slot is free again
+        ends = slot_free = time.monotonic()
+        try:
+            print("playing")
+            for index, audio_data in enumerate(audio_chunks):
+                if stopped.is_set():
+                    break
+                sound = pygame.mixer.Sound(file=io.BytesIO(audio_data))
+                if index:
+                    sound = self._with_pause(sound, SENTENCE_PAUSE_MS)
+                length = sound.get_length()
+                if self.channel.get_queue() is not None:
+                    # wait for the queued sound to start playing
+                    if stopped.wait(max(0.0, slot_free - time.monotonic()) + self.QUEUE_MARGIN):
+                        break
+                    while self.channel.get_queue() is not None:
+                        if stopped.wait(self.QUEUE_MARGIN):
+                            return
                 with self.lock:
-                    self.playing = False
+                    if stopped.is_set():
+                        break
+                    if self.channel.get_busy():
+                        self.channel.queue(sound)
+                        slot_free = ends
+                        ends += length
+                    else:
+                        # nothing playing (first sentence or the server was slower than playback)
+                        self.channel.play(sound)
+                        slot_free = time.monotonic()
+                        ends = slot_free + length
+            else:
+                # let the last sentence finish
+                if not stopped.wait(max(0.0, ends - time.monotonic())):
+                    while self.channel.get_busy() and not stopped.wait(self.QUEUE_MARGIN):
+                        pass
+                    print("playback complete")
+        except Exception as e:
+            print(f"playback error: {e}")
+            show_image('error')
+            time.sleep(1.0)
+            show_image('common')
+        finally:
+            # an interrupted stream closes its server request
+            close = getattr(audio_chunks, 'close', None)
+            if close:
+                close()
+            finished.set()
+
+#    the server trims the silence around every sentence, so the pause
+#    between sentences is put in front of each one after the first
+    def _with_pause(self, sound, pause_ms):
+        frequency, size, channels = pygame.mixer.get_init()
+        frame = abs(size) // 8 * channels
+        silence = bytes(int(frequency * pause_ms / 1000) * frame)
+        return pygame.mixer.Sound(buffer=silence + sound.get_raw())
 
-        threading.Thread(target=playback_thread, daemon=True).start()
-        
 #stop playback
     def stop(self):
         with self.lock:
+            self.stopped.set()
             try:
-                pygame.mixer.music.stop()
+                self.channel.stop()
             except:
                 pass
-            self.playing = False
+            self.finished.set()
             
 #speech recognition with continuous background listening
 class SileroSTTClient:
@@ -94,6 +169,9 @@ class SileroSTTClient:
         self.recognizer.dynamic_energy_adjustment_damping = DYNAMIC_ENERGY_ADJUSTMENT_DAMPING
         self.recognizer.pause_threshold = PAUSE_THRESHOLD
         self.recognizer.phrase_threshold = PHRASE_THRESHOLD
+        # persistent channel to the server and the request it is serving
+        self.channel = ConversationChannel() if TTS_WEBSOCKET else None
+        self.current_request = None
         try:
             self.microphone = sr.Microphone()
             with self.microphone as source:
@@ -188,11 +266,21 @@ class SileroSTTClient:
                 json={
                     "user_text": text,
                     "speaker": TTS_SPEAKER,
-                    "sample_rate": TTS_SAMPLE_RATE
+                    "sample_rate": TTS_SAMPLE_RATE,
+                    "format": TTS_FORMAT,
+                    "timeout": TTS_TIMEOUT
                 },
+                headers={"Accept": "audio/*" if TTS_BINARY else "application/json"},
                 timeout=TTS_TIMEOUT
             )
-            if response.status_code == 200:
+            if response.status_code == 200 and response.headers.get('Content-Type', '').startswith('audio/'):
+                # binary transport: wav body, text fields in headers
+                audio_data = response.content
+                is_error = response.headers.get('X-Is-Error') == 'true'
+                bot_response = unquote(response.headers.get('X-Bot-Response', ''))
+                print(f"received {len(audio_data)} bytes (error={is_error}, length={len(bot_response)})")
+                return audio_data, is_error
+            elif response.status_code == 200:
                 data = response.json()
                 audio_base64 = data.get('audio_base64')
                 is_error = data.get('is_error', False)
@@ -217,6 +305,129 @@ class SileroSTTClient:
             print(f"tts error: {e}")
             return None, False
 
+#        streaming variant of generate_speech using /conversation/stream
+#        returns: (audio_chunks, is_error) where audio_chunks yields wav bytes
+#        sentence by sentence, or (None, False) on failure
+    def generate_speech_stream(self, text):
+        try:
+            print(f"requesting stream: '{text[:50]}'")
+            response = requests.post(
+                f"{SERVER_URL}/conversation/stream",
+                json={
+                    "user_text": text,
+                    "speaker": TTS_SPEAKER,
+                    "sample_rate": TTS_SAMPLE_RATE,
+                    "format": TTS_FORMAT,
+                    "timeout": TTS_TIMEOUT
+                },
+                timeout=TTS_TIMEOUT,
+                stream=True
+            )
+            if response.status_code != 200:
+                print(f"server error {response.status_code}: {response.text}")
+                return None, False
+            events = iter_sse_events(response)
+            event, meta = next(events, (None, None))
+            if event != "meta":
+                print("unexpected stream start")
+                response.close()
+                return None, False
+            is_error = meta.get('is_error', False)
+            print(f"streaming {meta.get('chunks', 0)} chunks (error={is_error})")
+
+            def audio_chunks():
+                try:
+                    for event, data in events:
+                        if event == "audio":
+                            yield base64.b64decode(data['audio_base64'])
+                        elif event == "error":
+                            print(f"stream error: {data.get('message')}")
+                            return
+                        elif event == "done":
+                            return
+                except requests.exceptions.RequestException as e:
+                    print(f"stream interrupted: {e}")
+                finally:
+                    response.close()
+
+            return audio_chunks(), is_error
+        except requests.exceptions.Timeout:
+            print("server connection timeout")
+            return None, False
+        except requests.exceptions.ConnectionError:
+            print("server connection error")
+            return None, False
+        except Exception as e:
+            print(f"tts error: {e}")
+            return None, False
+
+#        websocket variant of generate_speech_stream over the persistent channel
+#        a new request cancels the previous one if it is still running
+#        returns: (audio_chunks, is_error) or (None, False) on failure
+    def generate_speech_ws(self, text):
+        self.cancel_current()
+        print(f"requesting ws: '{text[:50]}'")
+        request_id, events = self.channel.request(text)
+        if request_id is None:
+            print("server connection error")
+            return None, False
+        self.current_request = request_id
+        try:
+            while True:
+                kind, message = events.get(timeout=TTS_TIMEOUT)
+                if kind == 'meta':
+                    break
+                if kind in ('error', 'cancelled'):
+                    print(f"server error: {message.get('message', kind)}")
+                    self.channel.finish(request_id)
+                    return None, False
+        except queue.Empty:
+            print("server connection timeout")
+            self.channel.cancel(request_id)
+            return None, False
+        is_error = message.get('is_error', False)
+        print(f"streaming {message.get('chunks', 0)} chunks (error={is_error})")
+
+        def audio_chunks():
+            try:
+                while True:
+                    kind, data = events.get(timeout=TTS_TIMEOUT)
+                    if kind == 'audio':
+                        yield data
+                    elif kind == 'error':
+                        print(f"stream error: {data.get('message')}")
+                        return
+                    elif kind in ('done', 'cancelled'):
+                        return
+            except queue.Empty:
+                print("server connection timeout")
+                self.channel.cancel(request_id)
+            finally:
+                self.channel.finish(request_id)
+                if self.current_request == request_id:
+                    self.current_request = None
+
+        return audio_chunks(), is_error
+
+#    cancel the request in flight, its answer is no longer needed
+    def cancel_current(self):
+        if self.channel and self.current_request is not None:
+            self.channel.cancel(self.current_request)
+            self.current_request = None
+
+#parse server-sent events into (event, data) pairs
+def iter_sse_events(response):
+    event, data_lines = None, []
+    for line in response.iter_lines(decode_unicode=True):
+        if not line:
+            if event and data_lines:
+                yield event, json.loads("\n".join(data_lines))
+            event, data_lines = None, []
+        elif line.startswith("event:"):
+            event = line[6:].strip()
+        elif line.startswith("data:"):
+            data_lines.append(line[5:].strip())
+
 # initialize clients
 stt_client = SileroSTTClient()
 audio_player = AudioPlayer()
@@ -301,7 +512,12 @@ def process_command(clean_command):
     print(f"processing c: {clean_command}")
     show_image('rolled')
     # get audio response with error flag
-    audio_data, is_error = stt_client.generate_speech(clean_command)
+    if TTS_WEBSOCKET:
+        audio_data, is_error = stt_client.generate_speech_ws(clean_command)
+    elif TTS_STREAMING:
+        audio_data, is_error = stt_client.generate_speech_stream(clean_command)
+    else:
+        audio_data, is_error = stt_client.generate_speech(clean_command)
     if audio_data:
         print("response handling")
         # show error eyes if api failed, otherwise normal speaking face
@@ -310,14 +526,16 @@ def process_command(clean_command):
             show_image('error')
         else:
             show_image('happy')
-        audio_player.play_audio_from_server(audio_data)
+        if TTS_WEBSOCKET or TTS_STREAMING:
+            audio_player.play_audio_stream(audio_data)
+        else:
+            audio_player.play_audio_from_server(audio_data)
         # eye animation during playback
         def eye_animation():
             time.sleep(1.5)
             if not is_error:
                 show_image('flinch')
-            while audio_player.playing:
-                time.sleep(0.1)
+            audio_player.wait()
             show_image('common')
         threading.Thread(target=eye_animation, daemon=True).start()
     else:
@@ -411,6 +629,9 @@ def main():
     finally:
         if stt_client:
             stt_client.running = False
+            stt_client.cancel_current()
+            if stt_client.channel:
+                stt_client.channel.close()
         audio_player.stop()
         print("tts system stopped")
 
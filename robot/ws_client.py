@@ -0,0 +1,154 @@
+import json
+import queue
+import threading
+import time
+import itertools
+import websocket
+from config import *
+
+# persistent websocket channel to the server's /ws endpoint. one background
+# thread keeps the connection alive (reconnecting with backoff), reads
+# messages and routes them to the request they belong to by id; a second
+# one sends heartbeats and drops the connection when the server goes quiet
+class ConversationChannel:
+    def __init__(self, url=WS_URL):
+        self.url = url
+        self.ws = None
+        self.send_lock = threading.Lock()
+        self.requests = {}
+        self.requests_lock = threading.Lock()
+        self.ids = itertools.count(1)
+        self.connected = threading.Event()
+        self.running = True
+        self.last_seen = time.time()
+        threading.Thread(target=self._connection_loop, daemon=True, name="WS-Reader").start()
+        threading.Thread(target=self._heartbeat_loop, daemon=True, name="WS-Heartbeat").start()
+
+    def _connection_loop(self):
+        delay = 1.0
+        while self.running:
+            try:
+                self.ws = websocket.create_connection(self.url, timeout=WS_CONNECT_TIMEOUT)
+                self.ws.settimeout(None)
+                self.last_seen = time.time()
+                self.connected.set()
+                print("websocket connected")
+                delay = 1.0
+                self._read_loop()
+            except Exception as e:
+                if self.running:
+                    print(f"websocket error: {e}")
+            finally:
+                self.connected.clear()
+                self._fail_pending("connection lost")
+                try:
+                    if self.ws:
+                        self.ws.close()
+                except Exception:
+                    pass
+            if self.running:
+                time.sleep(delay)
+                delay = min(delay * 2, WS_RECONNECT_MAX_DELAY)
+
+    def _read_loop(self):
+        pending_audio = None
+        while self.running:
+            opcode, data = self.ws.recv_data()
+            self.last_seen = time.time()
+            if opcode == websocket.ABNF.OPCODE_CLOSE:
+                return
+            if opcode == websocket.ABNF.OPCODE_BINARY:
+                # binary frame belongs to the audio header received before it
+                if pending_audio:
+                    self._route(pending_audio['id'], ('audio', data))
+                    pending_audio = None
+                continue
+            if opcode != websocket.ABNF.OPCODE_TEXT:
+                continue
+            message = json.loads(data.decode('utf-8'))
+            kind = message.get('type')
+            if kind == 'ping':
+                self._send({'type': 'pong'})
+            elif kind == 'audio':
+                pending_audio = message
+            elif kind in ('meta', 'done', 'error', 'cancelled', 'progress'):
+                self._route(message.get('id'), (kind, message))
+
+    def _route(self, request_id, item):
+        with self.requests_lock:
+            events = self.requests.get(request_id)
+        if events:
+            events.put(item)
+
+    def _fail_pending(self, reason):
+        with self.requests_lock:
+            pending = list(self.requests.values())
+        for events in pending:
+            events.put(('error', {'message': reason}))
+
+    def _heartbeat_loop(self):
+        while self.running:
+            time.sleep(WS_HEARTBEAT_INTERVAL)
+            if not self.connected.is_set():
+                continue
+            if time.time() - self.last_seen > WS_HEARTBEAT_INTERVAL * WS_MISSED_HEARTBEATS:
+                print("websocket heartbeat lost, reconnecting")
+                try:
+                    self.ws.close()
+                except Exception:
+                    pass
+                continue
+            try:
+                self._send({'type': 'ping'})
+            except Exception:
+                pass
+
+    def _send(self, message):
+        with self.send_lock:
+            self.ws.send(json.dumps(message, ensure_ascii=False))
+
+    # start a request, returns (request_id, events queue) or (None, None) when
+    # the server cannot be reached in time
+    def request(self, text):
+        if not self.connected.wait(timeout=WS_CONNECT_TIMEOUT):
+            return None, None
+        request_id = next(self.ids)
+        events = queue.Queue()
+        with self.requests_lock:
+            self.requests[request_id] = events
+        try:
+            self._send({
+                'type': 'request',
+                'id': request_id,
+                'user_text': text,
+                'speaker': TTS_SPEAKER,
+                'sample_rate': TTS_SAMPLE_RATE,
+                'format': TTS_FORMAT,
+                # the server drops the request once nobody waits for it
+                'timeout': TTS_TIMEOUT,
+            })
+        except Exception as e:
+            print(f"websocket send error: {e}")
+            self.finish(request_id)
+            return None, None
+        return request_id, events
+
+    # tell the server the answer is no longer needed
+    def cancel(self, request_id):
+        try:
+            self._send({'type': 'cancel', 'id': request_id})
+        except Exception:
+            pass
+        self.finish(request_id)
+
+    def finish(self, request_id):
+        with self.requests_lock:
+            self.requests.pop(request_id, None)
+
+    def close(self):
+        self.running = False
+        try:
+            if self.ws:
+                self.ws.close()
+        except Exception:
+            pass
@@ -0,0 +1,511 @@
+import os
+import sys
+import mmap
+import time
+import base64
+import queue
+import sqlite3
+import hashlib
+import logging
+import argparse
+import threading
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+# cache key covers everything that changes the produced audio; wav keys
+# carry no format part so they stay valid for existing caches
+def cache_key(text, speaker, sample_rate, model_version, audio_format="wav"):
+    parts = [model_version, speaker, str(sample_rate), text]
+    if audio_format != "wav":
+        parts.append(audio_format)
+    raw = "\0".join(parts)
+    return hashlib.md5(raw.encode('utf-8')).hexdigest()
+
+# thread-safe lru of audio bytes bounded by total size
+class MemoryCache:
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.size = 0
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        with self.lock:
+            data = self.entries.get(key)
+            if data is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return data
+
+    def contains(self, key):
+        with self.lock:
+            return key in self.entries
+
+    def discard(self, key):
+        with self.lock:
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.size -= len(old)
+
+    def put(self, key, data):
+        # entries larger than the whole budget are never kept in memory
+        if len(data) > self.max_bytes:
+            return
+        with self.lock:
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.size -= len(old)
+            self.entries[key] = data
+            self.size += len(data)
+            while self.size > self.max_bytes:
+                _, evicted = self.entries.popitem(last=False)
+                self.size -= len(evicted)
+                self.evictions += 1
+
+    def stats(self):
+        with self.lock:
+            return {
+                "entries": len(self.entries),
+                "bytes": self.size,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
+
+# on-disk audio cache with a persistent sqlite index and a size cap.
+# files live in hash-prefix subdirectories (ab/cd/abcd....audio) so no single
+# directory grows huge; lookups go through the in-memory copy of the index
+# and never stat the filesystem
+class DiskCache:
+    INDEX_FILE = "index.sqlite3"
+    # entries hold wav or encoded audio, so the suffix is format-neutral
+    SUFFIX = ".audio"
+    # after eviction the cache shrinks to this fraction of its cap so that
+    # eviction runs once per batch of writes, not on every write
+    LOW_WATERMARK = 0.9
+    # access statistics are written back to the index at most this often;
+    # new entries are flushed by the cache writer as soon as its queue drains
+    FLUSH_INTERVAL = 30.0
+
+    def __init__(self, cache_dir, max_bytes, policy="lru"):
+        if policy not in ("lru", "lfu"):
+            raise ValueError(f"unknown eviction policy: {policy}")
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.policy = policy
+        self.lock = threading.Lock()
+        # serializes index writes; the commit syncs to disk, so it runs
+        # without self.lock and lookups never wait for it
+        self.db_lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.dirty = set()
+        self.removed = set()
+        self.last_flush = time.time()
+        os.makedirs(cache_dir, exist_ok=True)
+        self.shards = set()
+        self.db = sqlite3.connect(
+            os.path.join(cache_dir, self.INDEX_FILE),
+            check_same_thread=False
+        )
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS entries ("
+            "key TEXT PRIMARY KEY, size INTEGER, last_access REAL, hits INTEGER)"
+        )
+        # key -> [size, last_access, hits]
+        self.entries = {
+            key: [size, last_access, hits]
+            for key, size, last_access, hits
+            in self.db.execute("SELECT key, size, last_access, hits FROM entries")
+        }
+        self.size = sum(entry[0] for entry in self.entries.values())
+
+    def path(self, key):
+        return os.path.join(self.cache_dir, key[:2], key[2:4], key + self.SUFFIX)
+
+    def contains(self, key):
+        with self.lock:
+            return key in self.entries
+
+    def get(self, key):
+        with self.lock:
+            if key not in self.entries:
+                self.misses += 1
+                return None
+        try:
+            with open(self.path(key), 'rb') as f:
+                data = f.read()
+        except FileNotFoundError:
+            # file removed behind our back, forget it
+            with self.lock:
+                self._forget(key)
+                self.misses += 1
+            return None
+        self._touch(key)
+        return data
+
+    # path of a cached file for serving it without reading it into memory,
+    # counted as a hit; None on a miss
+    def locate(self, key):
+        with self.lock:
+            if key not in self.entries:
+                self.misses += 1
+                return None
+        path = self.path(key)
+        if not os.path.isfile(path):
+            with self.lock:
+                self._forget(key)
+                self.misses += 1
+            return None
+        self._touch(key)
+        return path
+
+    def _touch(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                entry[1] = time.time()
+                entry[2] += 1
+                self.dirty.add(key)
+            self.hits += 1
+            due = time.time() - self.last_flush > self.FLUSH_INTERVAL
+        if due:
+            self._flush(wait=False)
+
+    def put(self, key, data):
+        path = self.path(key)
+        shard = os.path.dirname(path)
+        if shard not in self.shards:
+            os.makedirs(shard, exist_ok=True)
+            self.shards.add(shard)
+        # write then rename so readers never see a partial file
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+        with self.lock:
+            old = self.entries.get(key)
+            if old is not None:
+                self.size -= old[0]
+            self.entries[key] = [len(data), time.time(), old[2] if old else 0]
+            self.size += len(data)
+            self.dirty.add(key)
+            self.removed.discard(key)
+            victims = []
+            if self.size > self.max_bytes:
+                victims = self._evict(int(self.max_bytes * self.LOW_WATERMARK))
+            due = time.time() - self.last_flush > self.FLUSH_INTERVAL
+        self._remove_files(victims)
+        if due:
+            self._flush(wait=False)
+
+    # drop entries from the index until the cache fits into target bytes,
+    # called with self.lock held. returns the evicted keys, their files are
+    # deleted by _remove_files once the lock is released
+    def _evict(self, target):
+        if self.policy == "lfu":
+            order = lambda item: (item[1][2], item[1][1])
+        else:
+            order = lambda item: item[1][1]
+        victims = []
+        for key, _ in sorted(self.entries.items(), key=order):
+            if self.size <= target:
+                break
+            self._forget(key)
+            self.evictions += 1
+            victims.append(key)
+        return victims
+
+    def _remove_files(self, keys):
+        if not keys:
+            return
+        # an evicted key written again in the meantime keeps its new file
+        with self.lock:
+            keys = [key for key in keys if key not in self.entries]
+        for key in keys:
+            try:
+                os.remove(self.path(key))
+            except FileNotFoundError:
+                pass
+
+    def _forget(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.size -= entry[0]
+            self.dirty.discard(key)
+            self.removed.add(key)
+
+    def flush(self):
+        self._flush()
+
+    # write pending index changes. must not be called with self.lock held;
+    # without wait it returns at once when another thread is flushing
+    def _flush(self, wait=True):
+        if not self.db_lock.acquire(blocking=wait):
+            return
+        try:
+            # the snapshot is taken under db_lock so snapshots commit in order
+            with self.lock:
+                rows = [(key, *self.entries[key]) for key in self.dirty]
+                removed = [(key,) for key in self.removed]
+                self.dirty.clear()
+                self.removed.clear()
+                self.last_flush = time.time()
+            if rows:
+                self.db.executemany(
+                    "INSERT OR REPLACE INTO entries (key, size, last_access, hits) "
+                    "VALUES (?, ?, ?, ?)",
+                    rows
+                )
+            if removed:
+                self.db.executemany("DELETE FROM entries WHERE key = ?", removed)
+            self.db.commit()
+        finally:
+            self.db_lock.release()
+
+    # full consistency pass: drops index rows without files, indexes sharded
+    # files missing from the index, deletes anything else (e.g. the old flat
+    # layout) and evicts down to max_bytes. scans the whole directory, so it
+    # is meant for the cli, not the request path
+    def gc(self):
+        removed_files = 0
+        with self.lock:
+            found = set()
+            for root, dirs, files in os.walk(self.cache_dir):
+                depth = os.path.relpath(root, self.cache_dir).count(os.sep)
+                for name in files:
+                    path = os.path.join(root, name)
+                    if root == self.cache_dir and name.startswith(self.INDEX_FILE):
+                        continue
+                    key = name[:-len(self.SUFFIX)]
+                    if (depth == 1 and name.endswith(self.SUFFIX)
+                            and root.endswith(os.path.join(key[:2], key[2:4]))):
+                        found.add(key)
+                        if key not in self.entries:
+                            stat = os.stat(path)
+                            self.entries[key] = [stat.st_size, stat.st_mtime, 0]
+                            self.size += stat.st_size
+                            self.dirty.add(key)
+                        continue
+                    os.remove(path)
+                    removed_files += 1
+            for key in list(self.entries):
+                if key not in found:
+                    self._forget(key)
+            victims = self._evict(self.max_bytes)
+            result = {
+                "removed_files": removed_files,
+                "evicted": len(victims),
+                "entries": len(self.entries),
+                "bytes": self.size,
+            }
+        self._remove_files(victims)
+        self._flush()
+        return result
+
+    def stats(self):
+        with self.lock:
+            return {
+                "entries": len(self.entries),
+                "bytes": self.size,
+                "max_bytes": self.max_bytes,
+                "policy": self.policy,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
+
+    def close(self):
+        self._flush()
+        with self.db_lock:
+            self.db.close()
+
+# in-memory lru in front of the on-disk audio cache. disk writes happen
+# on a background thread; until written, entries are served from pending
+class AudioCache:
+    def __init__(self, cache_dir, memory_bytes, disk_bytes, policy="lru", base64_bytes=0):
+        self.memory = MemoryCache(memory_bytes)
+        self.disk = DiskCache(cache_dir, disk_bytes, policy)
+        # base64 form of whole responses for json clients
+        self.base64_cache = MemoryCache(base64_bytes)
+        self.lock = threading.Lock()
+        self.pending = {}
+        self.write_queue = queue.Queue()
+        self.writer = threading.Thread(
+            target=self._write_loop,
+            daemon=True,
+            name="cache-writer"
+        )
+        self.writer.start()
+        # responses assembled from per-sentence entries
+        self.assembled = 0
+        self.full_hits = 0
+        self.partial_hits = 0
+        self.sentences = 0
+        self.sentence_hits = 0
+
+    def get(self, key):
+        data = self.memory.get(key)
+        if data is not None:
+            return data
+        with self.lock:
+            data = self.pending.get(key)
+        if data is not None:
+            return data
+        data = self.disk.get(key)
+        if data is not None:
+            # promote so the next request for a hot phrase skips the disk
+            self.memory.put(key, data)
+        return data
+
+    def put(self, key, data):
+        self.memory.put(key, data)
+        self.base64_cache.discard(key)
+        with self.lock:
+            self.pending[key] = data
+        self.write_queue.put(key)
+
+    # cached audio without copying it: (bytes, None) from memory or a pending
+    # write, (None, path) for a file on disk, (None, None) on a miss
+    def locate(self, key):
+        data = self.memory.get(key)
+        if data is None:
+            with self.lock:
+                data = self.pending.get(key)
+        if data is not None:
+            return data, None
+        return None, self.disk.locate(key)
+
+    # base64 of a cached entry, encoded once and kept in memory. disk entries
+    # are encoded straight from a memory map of the file
+    def base64(self, key):
+        encoded = self.base64_cache.get(key)
+        if encoded is not None:
+            return encoded
+        data, path = self.locate(key)
+        if data is not None:
+            encoded = base64.b64encode(data)
+        elif path is not None:
+            with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                encoded = base64.b64encode(mapped)
+        else:
+            return None
+        self.base64_cache.put(key, encoded)
+        return encoded
+
+    def cached_base64(self, key):
+        return self.base64_cache.get(key)
+
+    def put_base64(self, key, encoded):
+        self.base64_cache.put(key, encoded)
+
+    def contains(self, key):
+        with self.lock:
+            if key in self.pending:
+                return True
+        return self.memory.contains(key) or self.disk.contains(key)
+
+    def _write_loop(self):
+        while True:
+            key = self.write_queue.get()
+            if key is None:
+                return
+            with self.lock:
+                data = self.pending.get(key)
+            if data is None:
+                continue
+            try:
+                self.disk.put(key, data)
+            except Exception as e:
+                logger.error(f"cache write error: {e}")
+            with self.lock:
+                # a newer put of the same key stays pending for its own write
+                if self.pending.get(key) is data:
+                    del self.pending[key]
+            # one index commit per burst of writes, so entries on disk are
+            # indexed (and count towards the size cap) even if we get killed
+            if self.write_queue.empty():
+                try:
+                    self.disk.flush()
+                except Exception as e:
+                    logger.error(f"cache index error: {e}")
+
+    # count one response built from hits cached sentences out of total
+    def record_assembly(self, hits, total):
+        with self.lock:
+            self.assembled += 1
+            self.sentences += total
+            self.sentence_hits += hits
+            if hits == total:
+                self.full_hits += 1
+            elif hits:
+                self.partial_hits += 1
+
+    def stats(self):
+        with self.lock:
+            assembled = max(self.assembled, 1)
+            phrases = {
+                "responses": self.assembled,
+                "full_hits": self.full_hits,
+                "partial_hits": self.partial_hits,
+                "partial_hit_ratio": round(self.partial_hits / assembled, 4),
+                "sentences": self.sentences,
+                "sentence_hits": self.sentence_hits,
+                "sentence_hit_ratio": round(self.sentence_hits / max(self.sentences, 1), 4),
+            }
+        return {
+            "memory": self.memory.stats(),
+            "disk": self.disk.stats(),
+            "base64": self.base64_cache.stats(),
+            "phrases": phrases,
+        }
+
+    # wait for queued disk writes, then persist the index
+    def close(self):
+        self.write_queue.put(None)
+        self.writer.join()
+        self.disk.close()
+
+# cache maintenance cli, run it while the server is stopped:
+#   python audio_cache.py stats
+#   python audio_cache.py gc --max-mb 1024 --policy lfu
+def main():
+    parser = argparse.ArgumentParser(description="audio cache maintenance")
+    parser.add_argument("command", choices=["stats", "gc"])
+    parser.add_argument("--dir", default="audio_cache")
+    parser.add_argument("--max-mb", type=int, default=None,
+                        help="size cap for gc, no eviction when omitted")
+    parser.add_argument("--policy", choices=["lru", "lfu"], default="lru")
+    args = parser.parse_args()
+    if not os.path.isdir(args.dir):
+        print(f"no cache directory: {args.dir}")
+        return 1
+    max_bytes = sys.maxsize if args.max_mb is None else args.max_mb * 1024 * 1024
+    cache = DiskCache(args.dir, max_bytes, args.policy)
+    try:
+        if args.command == "gc":
+            result = cache.gc()
+            print(f"removed {result['removed_files']} stray files, "
+                  f"evicted {result['evicted']} entries")
+        stats = cache.stats()
+        print(f"entries: {stats['entries']}")
+        print(f"size: {stats['bytes'] / 1024 / 1024:.1f} MB")
+        if cache.entries:
+            hits = sorted(entry[2] for entry in cache.entries.values())
+            oldest = min(entry[1] for entry in cache.entries.values())
+            print(f"hits per entry: median {hits[len(hits) // 2]}, max {hits[-1]}")
+            print(f"oldest access: {time.strftime('%Y-%m-%d %H:%M', time.localtime(oldest))}")
+    finally:
+        cache.close()
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
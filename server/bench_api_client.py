@@ -0,0 +1,70 @@
+import argparse
+import json
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+import sileroserverNEW as server
+from standins import start_standin_api
+
+# per-request latency of external api calls: one connection per request
+# (the old requests.get path) against the pooled keep-alive session.
+# runs against a local stand-in api unless --url is given
+# usage: python bench_api_client.py [--requests 200] [--concurrency 1 8]
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="external api client benchmark")
+    parser.add_argument("--url", help="real api url, defaults to a local stand-in")
+    parser.add_argument("--latency-ms", type=float, default=0,
+                        help="stand-in api processing latency")
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 8])
+    parser.add_argument("--json", help="write results to this file")
+    return parser.parse_args()
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+def measure(requests_total, concurrency):
+    def one(index):
+        start = time.perf_counter()
+        if server.call_external_api(f"привет {index}")[0] is None:
+            raise RuntimeError("api call failed")
+        return (time.perf_counter() - start) * 1000
+
+    with ThreadPoolExecutor(concurrency) as pool:
+        latencies = list(pool.map(one, range(requests_total)))
+    return {
+        "mean_ms": round(sum(latencies) / len(latencies), 3),
+        "p50_ms": round(percentile(latencies, 50), 3),
+        "p99_ms": round(percentile(latencies, 99), 3),
+    }
+
+def main():
+    args = parse_args()
+    logging.getLogger(server.__name__).setLevel(logging.WARNING)
+    if args.url:
+        server.Config.API_URL = args.url
+    else:
+        _, server.Config.API_URL = start_standin_api(latency=args.latency_ms / 1000)
+    print(f"api: {server.Config.API_URL}")
+    results = []
+    for concurrency in args.concurrency:
+        for pooled in (False, True):
+            server.api_session = server.create_api_session() if pooled else None
+            # warm up so the pooled run starts with open connections
+            measure(concurrency, concurrency)
+            row = measure(args.requests, concurrency)
+            row.update({"pooled": pooled, "concurrency": concurrency})
+            results.append(row)
+            print(f"{'pooled ' if pooled else 'one-off'} clients={concurrency:<3} "
+                  f"mean {row['mean_ms']:7.2f}ms  p50 {row['p50_ms']:7.2f}ms  p99 {row['p99_ms']:7.2f}ms")
+            if server.api_session:
+                server.api_session.close()
+                server.api_session = None
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({"url": server.Config.API_URL, "results": results}, f, indent=2)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,90 @@
+import argparse
+import json
+import multiprocessing
+import os
+import resource
+import time
+from concurrent.futures import ProcessPoolExecutor
+import torch
+from tts_backends import BACKENDS, load_backend
+
+# real-time factor and memory footprint of every synthesis backend. each
+# backend runs in a fresh process so its memory is measured in isolation;
+# backends that cannot load (no model.pt and no network) are reported as
+# failed. rtf = synthesis time / audio duration, lower is faster
+# usage: python bench_backends.py [--backends standin silero silero-int8] [--threads 4]
+
+TEXTS = [
+    "Привет.",
+    "Сегодня в Москве облачно, днём до плюс двенадцати градусов.",
+    "Впереди препятствие, поворачиваю налево и продолжаю движение по коридору до двери.",
+]
+
+MODEL_URL = 'https://models.silero.ai/models/tts/ru/v4_ru.pt'
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="tts backend benchmark")
+    parser.add_argument("--backends", nargs="+", default=sorted(BACKENDS))
+    parser.add_argument("--runs", type=int, default=3, help="passes over the test texts")
+    parser.add_argument("--threads", type=int, default=4, help="torch threads")
+    parser.add_argument("--speaker", default="baya")
+    parser.add_argument("--sample-rate", type=int, default=48000)
+    parser.add_argument("--json", help="write results to this file")
+    return parser.parse_args()
+
+def rss_mb():
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 2 ** 20
+    except OSError:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+def measure(name, runs, threads, speaker, sample_rate):
+    torch.set_num_threads(threads)
+    before = rss_mb()
+    start = time.perf_counter()
+    try:
+        model = load_backend(name, model_file="model.pt", model_url=MODEL_URL)
+    except Exception as e:
+        return {"backend": name, "error": str(e)}
+    load_seconds = time.perf_counter() - start
+    loaded = rss_mb()
+    # first call pays for lazy initialization
+    model.apply_tts(text=TEXTS[0], speaker=speaker, sample_rate=sample_rate)
+    synthesis, audio = 0.0, 0.0
+    for _ in range(runs):
+        for text in TEXTS:
+            start = time.perf_counter()
+            waveform = model.apply_tts(text=text, speaker=speaker, sample_rate=sample_rate)
+            synthesis += time.perf_counter() - start
+            audio += len(waveform) / sample_rate
+    return {
+        "backend": name,
+        "load_seconds": round(load_seconds, 2),
+        "rtf": round(synthesis / audio, 4),
+        "audio_seconds": round(audio, 2),
+        "model_rss_mb": round(loaded - before, 1),
+        "peak_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+    }
+
+def main():
+    args = parse_args()
+    context = multiprocessing.get_context("spawn")
+    results = []
+    for name in args.backends:
+        with ProcessPoolExecutor(1, mp_context=context) as pool:
+            result = pool.submit(
+                measure, name, args.runs, args.threads, args.speaker, args.sample_rate
+            ).result()
+        results.append(result)
+        if "error" in result:
+            print(f"{name:<12} failed: {result['error']}")
+        else:
+            print(f"{name:<12} rtf={result['rtf']:<8} model={result['model_rss_mb']}MB "
+                  f"peak={result['peak_rss_mb']}MB load={result['load_seconds']}s")
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({"threads": args.threads, "results": results}, f, indent=2)
+
+if __name__ == "__main__":
+    main()
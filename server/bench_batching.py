@@ -0,0 +1,76 @@
+import argparse
+import asyncio
+import json
+import logging
+import tempfile
+import time
+import sileroserverNEW as server
+from standins import StandInTTSModel
+
+# throughput of the synthesis path with and without micro-batching
+# usage: python bench_batching.py [--silero] [--concurrency 1 4 16]
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="micro-batching throughput benchmark")
+    parser.add_argument("--silero", action="store_true",
+                        help="use the real silero model (model.pt) instead of the stand-in")
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 4, 16])
+    parser.add_argument("--requests", type=int, default=8,
+                        help="requests sent by every client")
+    parser.add_argument("--speaker", default="baya")
+    parser.add_argument("--sample-rate", type=int, default=48000)
+    parser.add_argument("--json", help="write results to this file")
+    return parser.parse_args()
+
+async def run_clients(concurrency, requests_per_client, speaker, sample_rate, tag):
+    async def client(index):
+        for number in range(requests_per_client):
+            # unique text per request so every call misses the cache
+            text = f"Проверка скорости синтеза {tag} {index} {number}."
+            audio_data, cached = await server.synthesize_audio(text, speaker, sample_rate)
+            if not audio_data:
+                raise RuntimeError("tts generation failed")
+
+    start = time.perf_counter()
+    await asyncio.gather(*(client(i) for i in range(concurrency)))
+    return concurrency * requests_per_client / (time.perf_counter() - start)
+
+def main():
+    args = parse_args()
+    logging.getLogger(server.__name__).setLevel(logging.WARNING)
+    server.audio_cache = server.AudioCache(
+        tempfile.mkdtemp(prefix="bench_cache_"),
+        server.Config.MEMORY_CACHE_BYTES,
+        server.Config.DISK_CACHE_BYTES
+    )
+    if args.silero:
+        if not server.load_tts_model():
+            raise SystemExit("failed to load silero model")
+    else:
+        server.tts_model = StandInTTSModel()
+    results = []
+    for batching in (False, True):
+        server.Config.TTS_BATCHING = batching
+        for concurrency in args.concurrency:
+            tag = f"{'b' if batching else 'n'}{concurrency}"
+            rps = asyncio.run(run_clients(
+                concurrency, args.requests, args.speaker, args.sample_rate, tag
+            ))
+            results.append({
+                "batching": batching,
+                "concurrency": concurrency,
+                "requests_per_sec": round(rps, 2),
+            })
+            print(f"batching={'on ' if batching else 'off'} "
+                  f"clients={concurrency:<3} {rps:8.2f} req/s")
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({
+                "model": "silero" if args.silero else "stand-in",
+                "workers": server.Config.TTS_WORKERS,
+                "window_ms": server.Config.BATCH_WINDOW_MS,
+                "results": results,
+            }, f, indent=2)
+
+if __name__ == "__main__":
+    main()
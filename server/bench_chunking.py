@@ -0,0 +1,87 @@
+import argparse
+import json
+import logging
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+import sileroserverNEW as server
+from standins import StandInTTSModel
+
+# latency of one long answer synthesized as parallel chunks, for 1..N model
+# replicas. the stand-in burns cpu like real inference, so latency should
+# fall roughly with the number of cores; use --silero for real numbers
+# usage: python bench_chunking.py [--silero] [--chars 2000] [--max-replicas 4]
+
+SENTENCE = ("Робот продолжает движение по коридору, обходит препятствие справа "
+            "и сообщает о заряде батареи {tag} {number}.")
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="long text chunked synthesis benchmark")
+    parser.add_argument("--silero", action="store_true",
+                        help="use the real silero model (model.pt) instead of the stand-in")
+    parser.add_argument("--chars", type=int, default=2000, help="length of the answer")
+    parser.add_argument("--max-replicas", type=int, default=len(server.available_cores()))
+    parser.add_argument("--runs", type=int, default=3)
+    parser.add_argument("--speaker", default="baya")
+    parser.add_argument("--sample-rate", type=int, default=48000)
+    parser.add_argument("--json", help="write results to this file")
+    return parser.parse_args()
+
+# unique text per run so nothing is served from the cache
+def long_text(chars, tag):
+    sentences, length = [], 0
+    while length < chars:
+        sentences.append(SENTENCE.format(tag=tag, number=len(sentences)))
+        length += len(sentences[-1]) + 1
+    return " ".join(sentences)
+
+def main():
+    args = parse_args()
+    logging.getLogger(server.__name__).setLevel(logging.WARNING)
+    server.audio_cache = server.AudioCache(
+        tempfile.mkdtemp(prefix="bench_cache_"),
+        server.Config.MEMORY_CACHE_BYTES,
+        server.Config.DISK_CACHE_BYTES
+    )
+    if args.silero:
+        if not server.load_tts_model():
+            raise SystemExit("failed to load silero model")
+    else:
+        server.tts_model = StandInTTSModel(overhead=0.05, per_char=0.002, busy=True)
+    results = []
+    baseline = None
+    for replicas in range(1, args.max_replicas + 1):
+        server.start_replicas(replicas)
+        server.chunk_executor = ThreadPoolExecutor(replicas)
+        try:
+            timings = []
+            for run in range(args.runs):
+                text = long_text(args.chars, f"{replicas}-{run}")
+                start = time.perf_counter()
+                data, _ = server.generate_audio(text, args.speaker, args.sample_rate)
+                timings.append(time.perf_counter() - start)
+                if not data:
+                    raise RuntimeError("tts generation failed")
+        finally:
+            server.chunk_executor.shutdown()
+            server.replica_pool.shutdown()
+            server.replica_pool = None
+        latency = min(timings)
+        baseline = baseline or latency
+        results.append({
+            "replicas": replicas,
+            "latency_s": round(latency, 3),
+            "speedup": round(baseline / latency, 2),
+        })
+        print(f"replicas={replicas:<3} {latency:7.3f}s  x{baseline / latency:.2f}")
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({
+                "model": "silero" if args.silero else "stand-in",
+                "chars": args.chars,
+                "cores": len(server.available_cores()),
+                "results": results,
+            }, f, indent=2)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,93 @@
+import argparse
+import io
+import json
+import logging
+import tempfile
+import time
+import soundfile as sf
+import sileroserverNEW as server
+from standins import StandInTTSModel
+
+# response size and delivery latency of every audio format against wav.
+# the link is modelled from its bandwidth and round-trip time, so the
+# numbers are reproducible without shaping a real network:
+#   latency = encode + rtt + bytes / bandwidth + client decode
+# usage: python bench_codecs.py [--silero] [--link-kbps 1000] [--rtt-ms 20]
+
+TEXTS = [
+    "Привет! Как дела?",
+    "Сегодня в Москве облачно, днём до плюс двенадцати градусов, вечером возможен небольшой дождь.",
+    "Это тестовое сообщение для проверки обработки длинного текста. " * 10,
+]
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="audio codec size/latency benchmark")
+    parser.add_argument("--silero", action="store_true",
+                        help="use the real silero model (model.pt) instead of the stand-in")
+    parser.add_argument("--link-kbps", type=float, default=1000,
+                        help="modelled link bandwidth in kbit/s")
+    parser.add_argument("--rtt-ms", type=float, default=20,
+                        help="modelled link round-trip time in ms")
+    parser.add_argument("--speaker", default="baya")
+    parser.add_argument("--sample-rate", type=int, default=48000)
+    parser.add_argument("--json", help="write results to this file")
+    return parser.parse_args()
+
+def timed(fn, *args, **kwargs):
+    start = time.perf_counter()
+    result = fn(*args, **kwargs)
+    return result, (time.perf_counter() - start) * 1000
+
+def main():
+    args = parse_args()
+    logging.getLogger(server.__name__).setLevel(logging.WARNING)
+    server.audio_cache = server.AudioCache(
+        tempfile.mkdtemp(prefix="bench_cache_"),
+        server.Config.MEMORY_CACHE_BYTES,
+        server.Config.DISK_CACHE_BYTES
+    )
+    if args.silero:
+        if not server.load_tts_model():
+            raise SystemExit("failed to load silero model")
+    else:
+        server.tts_model = StandInTTSModel(overhead=0, per_char=0)
+    wavs = []
+    for text in TEXTS:
+        wav_data, _ = server.generate_audio(text, args.speaker, args.sample_rate)
+        wavs.append(wav_data)
+    results = []
+    print(f"link: {args.link_kbps:g} kbit/s, rtt {args.rtt_ms:g} ms")
+    print(f"{'format':<6} {'bytes':>10} {'vs wav':>7} {'encode':>9} {'decode':>9} {'latency':>10}")
+    wav_bytes = sum(len(wav) for wav in wavs) / len(wavs)
+    for audio_format in server.AUDIO_FORMATS:
+        sizes, encode_ms, decode_ms, latency_ms = [], [], [], []
+        for wav_data in wavs:
+            data, encode = timed(server.encode_audio, wav_data, audio_format)
+            _, decode = timed(sf.read, io.BytesIO(data), dtype='int16')
+            transfer = len(data) * 8 / args.link_kbps
+            sizes.append(len(data))
+            encode_ms.append(encode)
+            decode_ms.append(decode)
+            latency_ms.append(encode + args.rtt_ms + transfer + decode)
+        row = {
+            "format": audio_format,
+            "avg_bytes": round(sum(sizes) / len(sizes)),
+            "ratio_vs_wav": round(sum(sizes) / len(sizes) / wav_bytes, 3),
+            "encode_ms": round(sum(encode_ms) / len(encode_ms), 1),
+            "decode_ms": round(sum(decode_ms) / len(decode_ms), 1),
+            "latency_ms": round(sum(latency_ms) / len(latency_ms), 1),
+        }
+        results.append(row)
+        print(f"{audio_format:<6} {row['avg_bytes']:>10} {row['ratio_vs_wav']:>7.3f} "
+              f"{row['encode_ms']:>7.1f}ms {row['decode_ms']:>7.1f}ms {row['latency_ms']:>8.1f}ms")
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({
+                "model": "silero" if args.silero else "stand-in",
+                "link_kbps": args.link_kbps,
+                "rtt_ms": args.rtt_ms,
+                "results": results,
+            }, f, indent=2)
+
+if __name__ == "__main__":
+    main()
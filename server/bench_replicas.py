@@ -0,0 +1,69 @@
+import argparse
+import json
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+import sileroserverNEW as server
+from standins import StandInTTSModel
+
+# synthesis throughput with 1..N model replicas pinned to disjoint cores.
+# the stand-in model burns cpu for its simulated cost, so it scales like
+# real inference would; use --silero for real numbers
+# usage: python bench_replicas.py [--silero] [--max-replicas 4]
+
+TEXT = "Сегодня в Москве облачно, днём до плюс двенадцати градусов."
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="model replica scaling benchmark")
+    parser.add_argument("--silero", action="store_true",
+                        help="use the real silero model (model.pt) instead of the stand-in")
+    parser.add_argument("--max-replicas", type=int, default=len(server.available_cores()))
+    parser.add_argument("--requests", type=int, default=32)
+    parser.add_argument("--speaker", default="baya")
+    parser.add_argument("--sample-rate", type=int, default=48000)
+    parser.add_argument("--json", help="write results to this file")
+    return parser.parse_args()
+
+def measure(requests_total, clients, speaker, sample_rate):
+    def one(_):
+        server.synthesize_wav(TEXT, speaker, sample_rate)
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(clients) as pool:
+        list(pool.map(one, range(requests_total)))
+    return requests_total / (time.perf_counter() - start)
+
+def main():
+    args = parse_args()
+    logging.getLogger(server.__name__).setLevel(logging.WARNING)
+    if args.silero:
+        if not server.load_tts_model():
+            raise SystemExit("failed to load silero model")
+    else:
+        server.tts_model = StandInTTSModel(overhead=0.05, per_char=0.001, busy=True)
+    results = []
+    baseline = None
+    for replicas in range(1, args.max_replicas + 1):
+        server.start_replicas(replicas)
+        try:
+            rps = measure(args.requests, replicas * 2, args.speaker, args.sample_rate)
+        finally:
+            server.replica_pool.shutdown()
+            server.replica_pool = None
+        baseline = baseline or rps
+        results.append({
+            "replicas": replicas,
+            "requests_per_sec": round(rps, 2),
+            "speedup": round(rps / baseline, 2),
+        })
+        print(f"replicas={replicas:<3} {rps:8.2f} req/s  x{rps / baseline:.2f}")
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({
+                "model": "silero" if args.silero else "stand-in",
+                "cores": len(server.available_cores()),
+                "results": results,
+            }, f, indent=2)
+
+if __name__ == "__main__":
+    main()
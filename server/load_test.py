@@ -0,0 +1,273 @@
+import argparse
+import json
+import logging
+import random
+import socket
+import tempfile
+import threading
+import time
+import requests
+import uvicorn
+import sileroserverNEW as server
+from standins import StandInTTSModel, start_standin_api
+
+# load generator for the conversation server. by default it runs
+# sileroserverNEW in-process with the stand-in model and a stand-in external
+# api, so it works offline; --url points it at an already running server.
+# reports throughput, latency percentiles and error rates per concurrency
+# level as json for comparing runs
+# usage: python load_test.py --concurrency 1 4 16 --cache-hit-ratio 0.5 --json out.json
+
+WORDS = [
+    "робот", "поворачивает", "налево", "сегодня", "погода", "солнечная",
+    "впереди", "препятствие", "батарея", "заряжена", "двигатель", "работает",
+    "камера", "видит", "человека", "комната", "свободна", "скорость", "низкая",
+]
+
+# number of sentences per text for every length class
+LENGTHS = {"short": 1, "medium": 3, "long": 8}
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="conversation server load test")
+    parser.add_argument("--url", help="test a running server instead of starting one locally")
+    parser.add_argument("--silero", action="store_true",
+                        help="use the real silero model (model.pt) instead of the stand-in")
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 4, 16])
+    parser.add_argument("--requests", type=int, default=50,
+                        help="requests sent at every concurrency level")
+    parser.add_argument("--lengths", default="short=0.6,medium=0.3,long=0.1",
+                        help="text length mix, sentences per class: "
+                             + ", ".join(f"{k}={v}" for k, v in LENGTHS.items()))
+    parser.add_argument("--cache-hit-ratio", type=float, default=0.5,
+                        help="share of requests repeating an already synthesized text")
+    parser.add_argument("--hot-phrases", type=int, default=20,
+                        help="size of the repeated text pool")
+    parser.add_argument("--api-latency-ms", type=float, default=50,
+                        help="stand-in external api latency")
+    parser.add_argument("--api-failure-rate", type=float, default=0.0,
+                        help="share of stand-in external api calls failing with 500")
+    parser.add_argument("--endpoint", choices=["conversation", "stream"], default="conversation")
+    parser.add_argument("--accept", default="application/json",
+                        help="Accept header for /conversation")
+    parser.add_argument("--format", default="wav", choices=sorted(server.AUDIO_FORMATS))
+    parser.add_argument("--speaker", default="baya")
+    parser.add_argument("--sample-rate", type=int, default=48000)
+    parser.add_argument("--timeout", type=float, default=60, help="client read timeout")
+    parser.add_argument("--deadline", type=float, default=30,
+                        help="seconds the client waits for an answer, sent to the server; "
+                             "answers within it count towards goodput")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--json", help="write results to this file")
+    return parser.parse_args()
+
+def parse_lengths(spec):
+    weights = {}
+    for item in spec.split(","):
+        name, _, weight = item.partition("=")
+        if name not in LENGTHS:
+            raise SystemExit(f"unknown length class: {name}")
+        weights[name] = float(weight)
+    return weights
+
+# every sentence carries a unique number so fresh texts never hit the
+# sentence cache by accident
+class TextGenerator:
+    def __init__(self, weights, seed):
+        self.random = random.Random(seed)
+        self.names = list(weights)
+        self.weights = [weights[name] for name in self.names]
+        self.counter = 0
+        self.lock = threading.Lock()
+
+    def sentence(self):
+        with self.lock:
+            self.counter += 1
+            number = self.counter
+            words = self.random.sample(WORDS, self.random.randint(3, 7))
+        return f"{' '.join(words).capitalize()} {number}."
+
+    def text(self):
+        with self.lock:
+            name = self.random.choices(self.names, self.weights)[0]
+        return " ".join(self.sentence() for _ in range(LENGTHS[name]))
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+# run the server with uvicorn on a background thread, returns (uvicorn server, base url)
+def start_local_server(args):
+    logging.getLogger(server.__name__).setLevel(logging.WARNING)
+    server.audio_cache = server.AudioCache(
+        tempfile.mkdtemp(prefix="load_cache_"),
+        server.Config.MEMORY_CACHE_BYTES,
+        server.Config.DISK_CACHE_BYTES,
+        server.Config.CACHE_POLICY,
+        server.Config.BASE64_CACHE_BYTES
+    )
+    _, server.Config.API_URL = start_standin_api(
+        latency=args.api_latency_ms / 1000, failure_rate=args.api_failure_rate
+    )
+    if args.silero:
+        if not server.load_tts_model():
+            raise SystemExit("failed to load silero model")
+    else:
+        server.tts_model = StandInTTSModel()
+    port = free_port()
+    uv = uvicorn.Server(uvicorn.Config(server.app, host="127.0.0.1", port=port, log_level="warning"))
+    threading.Thread(target=uv.run, daemon=True).start()
+    while not uv.started:
+        time.sleep(0.05)
+    return uv, f"http://127.0.0.1:{port}"
+
+def send(session, args, base_url, text):
+    payload = {
+        "user_text": text,
+        "speaker": args.speaker,
+        "sample_rate": args.sample_rate,
+        "format": args.format,
+        "timeout": args.deadline,
+    }
+    start = time.perf_counter()
+    if args.endpoint == "stream":
+        response = session.post(f"{base_url}/conversation/stream", json=payload,
+                                stream=True, timeout=args.timeout)
+        fallback = False
+        failed = response.status_code != 200
+        # read the whole stream, the request ends with the done event
+        for line in response.iter_lines(decode_unicode=True):
+            if line == "event: error":
+                failed = True
+            elif line.startswith("data: ") and '"is_error": true' in line:
+                fallback = True
+    else:
+        response = session.post(f"{base_url}/conversation", json=payload,
+                                headers={"Accept": args.accept}, timeout=args.timeout)
+        failed = response.status_code != 200
+        if response.headers.get("Content-Type", "").startswith("application/json") and not failed:
+            fallback = response.json().get("is_error", False)
+        else:
+            fallback = response.headers.get("X-Is-Error") == "true"
+    return time.perf_counter() - start, response.status_code, failed, fallback
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    index = min(len(values) - 1, max(0, round(fraction * len(values) + 0.5) - 1))
+    return values[index]
+
+def run_level(args, base_url, concurrency, texts):
+    results = []
+    lock = threading.Lock()
+
+    def client():
+        session = requests.Session()
+        while True:
+            with lock:
+                if not texts:
+                    return
+                text = texts.pop()
+            try:
+                result = send(session, args, base_url, text)
+            except requests.RequestException:
+                result = (None, None, True, False)
+            with lock:
+                results.append(result)
+
+    start = time.perf_counter()
+    threads = [threading.Thread(target=client) for _ in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+
+    latencies = sorted(r[0] for r in results if not r[2])
+    in_time = sum(1 for latency in latencies if latency <= args.deadline)
+    total = len(results)
+    ms = lambda value: None if value is None else round(value * 1000, 1)
+    return {
+        "concurrency": concurrency,
+        "requests": total,
+        "seconds": round(elapsed, 3),
+        "throughput_rps": round(total / elapsed, 2),
+        # answers delivered successfully within the deadline
+        "goodput_rps": round(in_time / elapsed, 2),
+        "latency_ms": {
+            "p50": ms(percentile(latencies, 0.50)),
+            "p95": ms(percentile(latencies, 0.95)),
+            "p99": ms(percentile(latencies, 0.99)),
+            "mean": ms(sum(latencies) / len(latencies) if latencies else None),
+            "max": ms(latencies[-1] if latencies else None),
+        },
+        "error_rate": round(sum(1 for r in results if r[2]) / max(total, 1), 4),
+        "busy_rate": round(sum(1 for r in results if r[1] == 503) / max(total, 1), 4),
+        "expired_rate": round(sum(1 for r in results if r[1] == 504) / max(total, 1), 4),
+        "api_fallback_rate": round(sum(1 for r in results if r[3]) / max(total, 1), 4),
+    }
+
+def cache_stats(base_url):
+    try:
+        return requests.get(f"{base_url}/cache/stats", timeout=5).json().get("phrases", {})
+    except (requests.RequestException, ValueError):
+        return {}
+
+def main():
+    args = parse_args()
+    generator = TextGenerator(parse_lengths(args.lengths), args.seed)
+    uv = None
+    if args.url:
+        base_url = args.url.rstrip("/")
+    else:
+        uv, base_url = start_local_server(args)
+    try:
+        # synthesize the hot pool once so repeats are real cache hits
+        hot = [generator.text() for _ in range(args.hot_phrases)]
+        session = requests.Session()
+        for text in hot:
+            send(session, args, base_url, text)
+
+        levels = []
+        for concurrency in args.concurrency:
+            texts = [
+                generator.random.choice(hot)
+                if hot and generator.random.random() < args.cache_hit_ratio
+                else generator.text()
+                for _ in range(args.requests)
+            ]
+            before = cache_stats(base_url)
+            level = run_level(args, base_url, concurrency, texts)
+            after = cache_stats(base_url)
+            sentences = after.get("sentences", 0) - before.get("sentences", 0)
+            if sentences > 0:
+                hits = after.get("sentence_hits", 0) - before.get("sentence_hits", 0)
+                level["sentence_hit_ratio"] = round(hits / sentences, 4)
+            levels.append(level)
+            latency = level["latency_ms"]
+            print(f"concurrency={concurrency:<4} {level['throughput_rps']:8.2f} req/s  goodput {level['goodput_rps']:.2f}  "
+                  f"p50={latency['p50']}ms p95={latency['p95']}ms p99={latency['p99']}ms  "
+                  f"errors={level['error_rate']:.2%}")
+    finally:
+        if uv:
+            uv.should_exit = True
+
+    report = {
+        "target": args.url or ("local silero" if args.silero else "local stand-in"),
+        "endpoint": args.endpoint,
+        "format": args.format,
+        "lengths": parse_lengths(args.lengths),
+        "cache_hit_ratio": args.cache_hit_ratio,
+        "deadline_s": args.deadline,
+        "api_latency_ms": None if args.url else args.api_latency_ms,
+        "api_failure_rate": None if args.url else args.api_failure_rate,
+        "levels": levels,
+    }
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(report, f, indent=2, ensure_ascii=False)
+    else:
+        print(json.dumps(report, indent=2, ensure_ascii=False))
+
+if __name__ == "__main__":
+    main()
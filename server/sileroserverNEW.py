@@ -1,16 +1,59 @@
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, Request, WebSocket, WebSocketDisconnect
 from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel
+from fastapi.responses import FileResponse, JSONResponse, Response, StreamingResponse
+from starlette.background import BackgroundTask
+from pydantic import BaseModel, Field, PrivateAttr, ValidationError, model_validator
+from typing import Literal, Optional
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor, ProcessPoolExecutor, as_completed
+from contextlib import asynccontextmanager
 import torch
+import numpy as np
+import soundfile as sf
 import os
+import io
+import re
+import json
+import time
+import asyncio
+import threading
+import multiprocessing
+import math
+import heapq
+import itertools
+import functools
 import base64
 import logging
 import requests
-import hashlib
+from requests.adapters import HTTPAdapter
+import struct
+import uuid
+import wave
+from urllib.parse import quote
+from audio_cache import AudioCache, cache_key
+from metrics import Registry, CONTENT_TYPE as METRICS_CONTENT_TYPE
+from tts_backends import load_backend
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
-app = FastAPI(title="Silero Server")
+
+# open the external api connection pool on startup, shut pools down with
+# the server
+@asynccontextmanager
+async def lifespan(app):
+    global api_session
+    api_session = create_api_session()
+    yield
+    tts_executor.shutdown()
+    api_executor.shutdown()
+    chunk_executor.shutdown(wait=False, cancel_futures=True)
+    if replica_pool is not None:
+        replica_pool.shutdown()
+    api_session.close()
+    api_session = None
+    audio_cache.close()
+
+app = FastAPI(title="Silero Server", lifespan=lifespan)
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["*"],
@@ -24,12 +67,124 @@ class Config:
     API_KEY = os.getenv("CONVERSATION_API_KEY", "keydsfg")
     API_TIMEOUT = 5
     CACHE_DIR = "audio_cache"
+    # byte budget of the in-memory lru in front of the disk cache
+    MEMORY_CACHE_BYTES = int(os.getenv("MEMORY_CACHE_MB", "64")) * 1024 * 1024
+    # size cap and eviction policy (lru or lfu) of the disk cache
+    DISK_CACHE_BYTES = int(os.getenv("DISK_CACHE_MB", "2048")) * 1024 * 1024
+    CACHE_POLICY = os.getenv("CACHE_POLICY", "lru")
+    # base64 of cached responses kept for json clients
+    BASE64_CACHE_BYTES = int(os.getenv("BASE64_CACHE_MB", "32")) * 1024 * 1024
+    MODEL_URL = 'https://models.silero.ai/models/tts/ru/v4_ru.pt'
+    # synthesis backend from tts_backends: silero, silero-int8 or standin
+    TTS_BACKEND = os.getenv("TTS_BACKEND", "silero")
+    # part of the cache key, change it when the model changes. backends
+    # other than silero produce different audio, so they get their own entries
+    MODEL_VERSION = os.getenv("MODEL_VERSION", "v4_ru") + (
+        "" if TTS_BACKEND == "silero" else f"-{TTS_BACKEND}"
+    )
+    # every synthesized sentence is trimmed of leading/trailing silence,
+    # normalized to TARGET_DBFS rms and faded in/out before it is cached
+    POSTPROCESS = os.getenv("POSTPROCESS", "1") == "1"
+    TRIM_THRESHOLD_DB = float(os.getenv("TRIM_THRESHOLD_DB", "-40"))
+    TRIM_MARGIN_MS = 20
+    TARGET_DBFS = float(os.getenv("TARGET_DBFS", "-18"))
+    FADE_MS = 5
+    # processed audio is cached apart from raw audio and other settings
+    if POSTPROCESS:
+        MODEL_VERSION += f"+pp{TRIM_THRESHOLD_DB:g},{TRIM_MARGIN_MS},{TARGET_DBFS:g},{FADE_MS}"
+    # torch threads of the in-process model
+    TORCH_THREADS = int(os.getenv("TORCH_THREADS", "4"))
+    # model replicas in worker processes pinned to disjoint cores, 0 keeps
+    # the single in-process model
+    TTS_REPLICAS = int(os.getenv("TTS_REPLICAS", "0"))
+    # synthesis worker pool and its queue (jobs waiting for a free worker)
+    TTS_WORKERS = int(os.getenv("TTS_WORKERS", str(max(2, TTS_REPLICAS))))
+    TTS_QUEUE_SIZE = int(os.getenv("TTS_QUEUE_SIZE", "16"))
+    # threads for blocking external api calls
+    API_WORKERS = int(os.getenv("API_WORKERS", "16"))
+    # keep-alive connection pool to the external api: number of hosts kept
+    # pooled and connections per host (callers wait when a host is at its limit)
+    API_POOL_HOSTS = int(os.getenv("API_POOL_HOSTS", "4"))
+    API_POOL_PER_HOST = int(os.getenv("API_POOL_PER_HOST", "16"))
+    # answers of the external api are memoized per normalized question for
+    # ANSWER_CACHE_TTL seconds, at most ANSWER_CACHE_SIZE of them; 0 disables
+    ANSWER_CACHE_TTL = float(os.getenv("ANSWER_CACHE_TTL", "300"))
+    ANSWER_CACHE_SIZE = int(os.getenv("ANSWER_CACHE_SIZE", "1024"))
+    # seconds a client should wait before retrying when the queue is full
+    RETRY_AFTER = 2
+    # websocket channel: server ping interval, and the connection is closed
+    # after this many intervals without any message from the client
+    WS_HEARTBEAT = float(os.getenv("WS_HEARTBEAT", "10"))
+    WS_MISSED_HEARTBEATS = 3
+    # synthesize the error echo while the external api call is in flight
+    SPECULATIVE_ECHO = os.getenv("SPECULATIVE_ECHO", "1") == "1"
+    # collect synthesis requests for a few ms and run them as one job
+    TTS_BATCHING = os.getenv("TTS_BATCHING", "1") == "1"
+    BATCH_WINDOW_MS = float(os.getenv("BATCH_WINDOW_MS", "5"))
+    MAX_BATCH_SIZE = int(os.getenv("MAX_BATCH_SIZE", "8"))
+    # the model always synthesizes at this rate, other rates are resampled
+    # from the cached master sentence
+    MASTER_SAMPLE_RATE = int(os.getenv("MASTER_SAMPLE_RATE", "48000"))
+    # silence inserted between cached sentences when assembling a response
+    SENTENCE_PAUSE_MS = int(os.getenv("SENTENCE_PAUSE_MS", "150"))
+    # sentences longer than this are split at clauses into chunks that are
+    # synthesized in parallel and joined with a short crossfade
+    MAX_CHUNK_CHARS = int(os.getenv("MAX_CHUNK_CHARS", "200"))
+    CROSSFADE_MS = int(os.getenv("CROSSFADE_MS", "10"))
+    # threads synthesizing the chunks of responses concurrently, enough to
+    # keep every tts worker and every replica (or every TORCH_THREADS cores) busy
+    CHUNK_WORKERS = int(os.getenv("CHUNK_WORKERS", str(
+        max(TTS_WORKERS, TTS_REPLICAS, (os.cpu_count() or 1) // TORCH_THREADS)
+    )))
+    # seconds a client waits for its answer unless the request says otherwise;
+    # work for requests past their deadline is dropped, not finished late
+    REQUEST_TIMEOUT = float(os.getenv("REQUEST_TIMEOUT", "30"))
+    # how often a plain http request checks whether its client went away
+    DISCONNECT_POLL = 0.5
+    # voices, rates and formats synthesized by --prewarm
+    PREWARM_SPEAKERS = os.getenv("PREWARM_SPEAKERS", "baya").split(",")
+    PREWARM_SAMPLE_RATES = [int(r) for r in os.getenv("PREWARM_SAMPLE_RATES", "48000").split(",")]
+    PREWARM_FORMATS = os.getenv("PREWARM_FORMATS", "wav").split(",")
+    # voices with their own metric series (silero v4_ru speakers)
+    METRIC_SPEAKERS = set(os.getenv("METRIC_SPEAKERS", "aidar,baya,kseniya,xenia,eugene,random").split(","))
+
+# playback rates a client may ask for. the resampling kernel grows with
+# the reduced ratio to MASTER_SAMPLE_RATE, so arbitrary rates are refused
+SampleRate = Literal[8000, 16000, 22050, 24000, 44100, 48000]
+# accepted rates the opus codec can encode at
+OPUS_SAMPLE_RATES = (8000, 16000, 24000, 48000)
 
 # request model for conversation endpoint
 class ConversationRequest(BaseModel):
     user_text: str
     speaker: str = "baya"
-    sample_rate: int = 48000
+    # playback rate of the client, anything but MASTER_SAMPLE_RATE is resampled
+    sample_rate: SampleRate = 48000
+    format: Literal["wav", "flac", "ogg", "opus"] = "wav"
+    # seconds the client waits for the answer (REQUEST_TIMEOUT when omitted)
+    timeout: Optional[float] = Field(None, gt=0)
+    # false for questions whose answer must not come from (or go to) the
+    # answer cache, e.g. "what time is it"
+    cache_answer: bool = True
+    _received: float = PrivateAttr(default_factory=time.monotonic)
+
+    @model_validator(mode="after")
+    def check_format_rate(self):
+        if self.format == "opus" and self.sample_rate not in OPUS_SAMPLE_RATES:
+            raise ValueError(
+                f"opus supports sample rates {', '.join(map(str, OPUS_SAMPLE_RATES))}, "
+                f"not {self.sample_rate}"
+            )
+        return self
+
+    @property
+    def wait(self):
+        return self.timeout or Config.REQUEST_TIMEOUT
+
+    # monotonic time after which nobody is waiting for the answer
+    @property
+    def deadline(self):
+        return self._received + self.wait
 
 # response model for conversation endpoint
 class ConversationResponse(BaseModel):
@@ -39,127 +194,1517 @@ class ConversationResponse(BaseModel):
     bot_response: str
     is_error: bool = False
     message: str
+    format: str = "wav"
+
+# raised when a worker pool has no free slot left
+class QueueFullError(Exception):
+    pass
+
+# raised instead of running work whose client deadline has passed
+class DeadlineExceeded(Exception):
+    pass
+
+# worker pool that accepts at most workers + queue_size jobs at once,
+# rejecting the rest instead of letting the backlog grow without bound.
+# queued jobs run earliest deadline first (fifo without a deadline); jobs
+# that expired or were cancelled while queued are dropped, not run
+class BoundedExecutor:
+    def __init__(self, name, workers, queue_size):
+        self.name = name
+        self.workers = workers
+        self.max_pending = workers + queue_size
+        self.pending = 0
+        self.lock = threading.Lock()
+        self.available = threading.Condition(self.lock)
+        self.queue = []
+        self.order = itertools.count()
+        self.running = True
+        for index in range(workers):
+            threading.Thread(
+                target=self._work,
+                name=f"{name}_{index}",
+                daemon=True
+            ).start()
+
+    def is_full(self):
+        with self.lock:
+            return self.pending >= self.max_pending
+
+    def has_idle_worker(self):
+        with self.lock:
+            return self.pending < self.workers
+
+    # priority orders the queue and defaults to the deadline; a batch of
+    # requests is due at its earliest deadline but dead only after its latest
+    def submit(self, fn, *args, deadline=None, priority=None):
+        if priority is None:
+            priority = deadline
+        future = Future()
+        with self.lock:
+            if not self.running:
+                raise RuntimeError(f"{self.name} pool is shut down")
+            if self.pending >= self.max_pending:
+                raise QueueFullError(f"{self.name} queue is full")
+            self.pending += 1
+            heapq.heappush(self.queue, (
+                math.inf if priority is None else priority,
+                next(self.order), future, fn, args, deadline
+            ))
+            self.available.notify()
+        return future
+
+    def _work(self):
+        while True:
+            with self.lock:
+                while self.running and not self.queue:
+                    self.available.wait()
+                if not self.queue:
+                    return
+                _, _, future, fn, args, deadline = heapq.heappop(self.queue)
+            try:
+                if not future.set_running_or_notify_cancel():
+                    DROPPED.inc(reason="cancelled")
+                elif deadline is not None and time.monotonic() > deadline:
+                    DROPPED.inc(reason="expired")
+                    future.set_exception(DeadlineExceeded(f"{self.name} job expired in queue"))
+                else:
+                    try:
+                        future.set_result(fn(*args))
+                    except BaseException as e:
+                        future.set_exception(e)
+            finally:
+                with self.lock:
+                    self.pending -= 1
+
+    # run blocking fn in the pool without blocking the event loop
+    async def run(self, fn, *args, deadline=None):
+        return await asyncio.wrap_future(self.submit(fn, *args, deadline=deadline))
+
+    def shutdown(self):
+        with self.lock:
+            self.running = False
+            queued, self.queue = self.queue, []
+            self.pending -= len(queued)
+            self.available.notify_all()
+        for job in queued:
+            job[2].cancel()
+
+tts_executor = BoundedExecutor("tts", Config.TTS_WORKERS, Config.TTS_QUEUE_SIZE)
+api_executor = BoundedExecutor("api", Config.API_WORKERS, Config.API_WORKERS)
+# runs fn once per key at a time: callers arriving while a call for the
+# same key is in flight wait for its result instead of repeating the work.
+# returns (result, shared), shared is True for the callers that waited
+class SingleFlight:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.calls = {}
+
+    def do(self, key, fn, *args):
+        with self.lock:
+            future = self.calls.get(key)
+            leader = future is None
+            if leader:
+                future = self.calls[key] = Future()
+        if not leader:
+            return future.result(), True
+        try:
+            result = fn(*args)
+            future.set_result(result)
+            return result, False
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self.lock:
+                del self.calls[key]
+
+# identical sentences requested together (e.g. every robot answering the
+# same broadcast) are synthesized and written to the cache once
+synthesis_flights = SingleFlight()
+
+# chunks are submitted from tts workers, so they need a pool of their own:
+# waiting on the tts pool from inside it could deadlock
+chunk_executor = ThreadPoolExecutor(Config.CHUNK_WORKERS, thread_name_prefix="chunk")
+
+@app.exception_handler(DeadlineExceeded)
+async def deadline_handler(request: Request, exc: DeadlineExceeded):
+    logger.warning(f"dropping request: {exc}")
+    return JSONResponse(status_code=504, content={"detail": "deadline exceeded"})
+
+@app.exception_handler(QueueFullError)
+async def queue_full_handler(request: Request, exc: QueueFullError):
+    logger.warning(f"rejecting request: {exc}")
+    return JSONResponse(
+        status_code=503,
+        content={"detail": "server busy, retry later"},
+        headers={"Retry-After": str(Config.RETRY_AFTER)}
+    )
 
-# global tts model variable
+# fail fast before doing any work when synthesis cannot be queued
+def check_capacity():
+    if tts_executor.is_full():
+        raise QueueFullError("tts queue is full")
+
+# global tts model variable, any object with apply_tts (see tts_backends)
 tts_model = None
 # try to load model if none is found
 def load_tts_model():
     global tts_model
     try:
-        device = torch.device('cpu')
-        torch.set_num_threads(4)
-        local_file = 'model.pt'
-        if not os.path.isfile(local_file):
-            logger.info("downloading silero model...")
-            torch.hub.download_url_to_file(
-                'https://models.silero.ai/models/tts/ru/v4_ru.pt',
-                local_file
-            )
-        tts_model = torch.package.PackageImporter(local_file).load_pickle(
-            "tts_models", "model"
+        torch.set_num_threads(Config.TORCH_THREADS)
+        tts_model = load_backend(
+            Config.TTS_BACKEND,
+            model_file='model.pt',
+            model_url=Config.MODEL_URL
         )
-        tts_model.to(device)
-        logger.info("model loaded successfully")
+        logger.info(f"model loaded successfully ({Config.TTS_BACKEND})")
         return True
     except Exception as e:
         logger.error(f"model load error: {e}")
         return False
 
-def get_cache_path(text):
-    if not os.path.exists(Config.CACHE_DIR):
-        os.makedirs(Config.CACHE_DIR)
-    text_hash = hashlib.md5(text.encode('utf-8')).hexdigest()
-    return os.path.join(Config.CACHE_DIR, f"{text_hash}.wav")
-
-def get_cached_audio(text):
-    path = get_cache_path(text)
-    if os.path.exists(path):
-        with open(path, 'rb') as f:
-            return f.read()
-    return None
-
-def save_to_cache(text, data):
-    path = get_cache_path(text)
-    with open(path, 'wb') as f:
-        f.write(data)
-
-def generate_audio(text, speaker, sample_rate):
-    # check cache first
-    cached = get_cached_audio(text)
+audio_cache = AudioCache(
+    Config.CACHE_DIR,
+    Config.MEMORY_CACHE_BYTES,
+    Config.DISK_CACHE_BYTES,
+    Config.CACHE_POLICY,
+    Config.BASE64_CACHE_BYTES
+)
+
+# prometheus metrics served on /metrics
+metrics = Registry()
+SPEAKER_LABELS = ("speaker", "sample_rate")
+
+# speaker comes from the client, so only known voices get series of their
+# own; anything else is counted as "other"
+def speaker_label(speaker):
+    return speaker if speaker in Config.METRIC_SPEAKERS else "other"
+API_SECONDS = metrics.histogram(
+    "silero_external_api_seconds", "external conversation api latency",
+    SPEAKER_LABELS + ("result",)
+)
+SYNTHESIS_SECONDS = metrics.histogram(
+    "silero_synthesis_seconds", "model synthesis time per sentence", SPEAKER_LABELS
+)
+ENCODING_SECONDS = metrics.histogram(
+    "silero_encoding_seconds", "compressed codec encoding time",
+    SPEAKER_LABELS + ("format",)
+)
+REQUEST_SECONDS = metrics.histogram(
+    "silero_request_seconds", "total request time",
+    ("endpoint",) + SPEAKER_LABELS
+)
+IN_FLIGHT = metrics.gauge(
+    "silero_requests_in_flight", "requests being processed",
+    ("endpoint",) + SPEAKER_LABELS
+)
+CACHE_LOOKUPS = metrics.counter(
+    "silero_sentence_cache_lookups_total", "per-sentence cache lookups",
+    SPEAKER_LABELS + ("result",)
+)
+RESAMPLING_SECONDS = metrics.histogram(
+    "silero_resampling_seconds", "time to derive a sentence at a client rate", SPEAKER_LABELS
+)
+DROPPED = metrics.counter(
+    "silero_dropped_total", "work skipped because its client deadline passed or the client gave up",
+    ("reason",)
+)
+LATE = metrics.counter(
+    "silero_late_responses_total", "responses finished after the client deadline", ("endpoint",)
+)
+RESPONSE_HITS = metrics.counter(
+    "silero_response_cache_hits_total", "whole answers served straight from the cache",
+    ("transport",)
+)
+ANSWER_CACHE = metrics.counter(
+    "silero_answer_cache_total", "external api answer cache lookups and refused stores",
+    ("result",)
+)
+ANSWER_AGE = metrics.histogram(
+    "silero_answer_cache_age_seconds", "age of answers served from the answer cache",
+    buckets=(1, 10, 30, 60, 120, 300, 600, 1800, 3600)
+)
+COALESCED = metrics.counter(
+    "silero_coalesced_total", "cache misses served by an identical synthesis in flight",
+    SPEAKER_LABELS + ("format",)
+)
+
+def cache_tier_stats(field):
+    stats = audio_cache.stats()
+    return {(tier,): stats[tier][field] for tier in ("memory", "disk", "base64")}
+
+metrics.callback("silero_cache_hits_total", "cache hits per tier", "counter",
+                 lambda: cache_tier_stats("hits"), ("tier",))
+metrics.callback("silero_cache_misses_total", "cache misses per tier", "counter",
+                 lambda: cache_tier_stats("misses"), ("tier",))
+metrics.callback("silero_cache_evictions_total", "cache evictions per tier", "counter",
+                 lambda: cache_tier_stats("evictions"), ("tier",))
+metrics.callback("silero_cache_bytes", "cached bytes per tier", "gauge",
+                 lambda: cache_tier_stats("bytes"), ("tier",))
+metrics.callback("silero_tts_pending", "synthesis jobs running or queued", "gauge",
+                 lambda: {(): tts_executor.pending})
+metrics.callback("silero_tts_queue_depth", "synthesis jobs waiting for a worker", "gauge",
+                 lambda: {(): max(0, tts_executor.pending - tts_executor.workers)})
+metrics.callback("silero_answer_cache_entries", "answers held by the answer cache", "gauge",
+                 lambda: {(): len(answer_cache)})
+
+# split text into sentences for streaming and per-sentence caching
+SENTENCE_SPLIT_RE = re.compile(r'(?<=[.!?…])\s+')
+
+def split_sentences(text):
+    parts = (normalize_sentence(p) for p in SENTENCE_SPLIT_RE.split(text))
+    return [p for p in parts if p]
+
+# same sentence with different spacing shares one cache entry
+def normalize_sentence(text):
+    return " ".join(text.split())
+
+CLAUSE_SPLIT_RE = re.compile(r'(?<=[,;:—–])\s+')
+
+# split an over-long sentence into chunks of at most max_chars, at clause
+# boundaries where possible and between words otherwise
+def split_chunks(sentence, max_chars):
+    if len(sentence) <= max_chars:
+        return [sentence]
+    pieces = []
+    for clause in CLAUSE_SPLIT_RE.split(sentence):
+        pieces.extend([clause] if len(clause) <= max_chars else clause.split())
+    chunks = [pieces[0]]
+    for piece in pieces[1:]:
+        if len(chunks[-1]) + 1 + len(piece) > max_chars:
+            chunks.append(piece)
+        else:
+            chunks[-1] += " " + piece
+    return chunks
+
+# join the chunks of one sentence, overlapping neighbours by crossfade_ms
+# with linear fades so the seams don't click
+def crossfade_wav(segments, crossfade_ms):
+    if len(segments) == 1:
+        return segments[0]
+    waves = []
+    for segment in segments:
+        with wave.open(io.BytesIO(segment), 'rb') as f:
+            sample_rate = f.getframerate()
+            waves.append(np.frombuffer(f.readframes(f.getnframes()), dtype='<i2').astype(np.float32))
+    overlap = int(sample_rate * crossfade_ms / 1000)
+    parts, tail = [], waves[0]
+    for current in waves[1:]:
+        n = min(overlap, len(tail), len(current))
+        ramp = np.linspace(0.0, 1.0, n, dtype=np.float32)
+        parts.append(tail[:len(tail) - n])
+        parts.append(tail[len(tail) - n:] * (1.0 - ramp) + current[:n] * ramp)
+        tail = current[n:]
+    parts.append(tail)
+    pcm = np.clip(np.concatenate(parts), -32768, 32767).astype('<i2')
+    return WAV_HEADER.pack(*wav_header(len(pcm), sample_rate)) + pcm.tobytes()
+
+# join wav segments into one wav with a short pause between them
+def concat_wav(segments, pause_ms):
+    frames = []
+    for segment in segments:
+        with wave.open(io.BytesIO(segment), 'rb') as f:
+            params = f.getparams()
+            frames.append(f.readframes(f.getnframes()))
+    pause_frames = int(params.framerate * pause_ms / 1000)
+    silence = b"\0" * (pause_frames * params.sampwidth * params.nchannels)
+    buffer = io.BytesIO()
+    with wave.open(buffer, 'wb') as f:
+        f.setnchannels(params.nchannels)
+        f.setsampwidth(params.sampwidth)
+        f.setframerate(params.framerate)
+        f.writeframes(silence.join(frames))
+    return buffer.getvalue()
+
+# audio formats: content type, soundfile container and subtype
+AUDIO_FORMATS = {
+    "wav": ("audio/wav", None, None),
+    "flac": ("audio/flac", "FLAC", "PCM_16"),
+    "ogg": ("audio/ogg", "OGG", "VORBIS"),
+    "opus": ("audio/ogg; codecs=opus", "OGG", "OPUS"),
+}
+
+# re-encode synthesized wav into a compressed format in-process
+def encode_audio(wav_data, audio_format):
+    if audio_format == "wav":
+        return wav_data
+    _, container, subtype = AUDIO_FORMATS[audio_format]
+    samples, sample_rate = sf.read(io.BytesIO(wav_data), dtype='float32')
+    buffer = io.BytesIO()
+    sf.write(buffer, samples, sample_rate, format=container, subtype=subtype)
+    return buffer.getvalue()
+
+# sentences of a text, each as its list of chunks
+def sentence_chunks(text):
+    return [
+        split_chunks(sentence, Config.MAX_CHUNK_CHARS)
+        for sentence in split_sentences(text) or [text]
+    ]
+
+# cache key of a whole response: encoded variants and assembled wavs are
+# cached whole, a single-chunk wav is its sentence entry
+def response_key(text, speaker, sample_rate, audio_format="wav"):
+    if audio_format != "wav":
+        return cache_key(text, speaker, sample_rate, Config.MODEL_VERSION, audio_format)
+    sentences = sentence_chunks(text)
+    if len(sentences) == 1 and len(sentences[0]) == 1:
+        return cache_key(sentences[0][0], speaker, sample_rate, Config.MODEL_VERSION)
+    return cache_key(text, speaker, sample_rate, Config.MODEL_VERSION, "assembled")
+
+# requesters are the (deadline, abandoned event) pairs of the clients
+# waiting for the audio; chunks nobody waits for any more are not synthesized
+def generate_audio(text, speaker, sample_rate, audio_format="wav", requesters=()):
+    # encoded variants are built from the wav and cached as a whole
+    if audio_format != "wav":
+        key = cache_key(text, speaker, sample_rate, Config.MODEL_VERSION, audio_format)
+        cached = audio_cache.get(key)
+        if cached:
+            return cached, True
+        while True:
+            try:
+                (data, cached), shared = synthesis_flights.do(
+                    key, generate_encoded, key, text, speaker, sample_rate, audio_format, requesters
+                )
+                break
+            except DeadlineExceeded:
+                # the flight carries the requesters of its leader only: when
+                # they are gone but ours still wait, run it again as leader
+                if abandoned_reason(requesters):
+                    raise
+            except Exception as e:
+                logger.error(f"{audio_format} encoding error: {e}")
+                return None, False
+        if shared:
+            COALESCED.inc(speaker=speaker_label(speaker), sample_rate=sample_rate, format=audio_format)
+        return data, cached or shared
+    # wav responses are assembled from independently cached sentences, so
+    # answers sharing most of their sentences only synthesize the rest.
+    # long sentences are cached and synthesized as chunks. the assembled
+    # wav is cached too, so a repeated answer is a single lookup
+    sentences = sentence_chunks(text)
+    chunks = list(dict.fromkeys(chunk for sentence in sentences for chunk in sentence))
+    assembled_key = None
+    if len(sentences) > 1 or len(sentences[0]) > 1:
+        assembled_key = response_key(text, speaker, sample_rate)
+        cached = audio_cache.get(assembled_key)
+        if cached:
+            audio_cache.record_assembly(len(chunks), len(chunks))
+            return cached, True
+    results = dict(zip(chunks, generate_chunks(chunks, speaker, sample_rate, requesters)))
+    if not all(data for data, _ in results.values()):
+        return None, False
+    hits = sum(cached for _, cached in results.values())
+    audio_cache.record_assembly(hits, len(chunks))
+    segments = [
+        crossfade_wav([results[chunk][0] for chunk in sentence], Config.CROSSFADE_MS)
+        for sentence in sentences
+    ]
+    data = segments[0] if len(segments) == 1 else concat_wav(segments, Config.SENTENCE_PAUSE_MS)
+    if assembled_key:
+        audio_cache.put(assembled_key, data)
+    return data, hits == len(chunks)
+
+# encode the wav into audio_format and cache it, run once per key at a time
+def generate_encoded(key, text, speaker, sample_rate, audio_format, requesters=()):
+    # the previous flight for this key may have finished after our lookup
+    data = audio_cache.get(key) if audio_cache.contains(key) else None
+    if data:
+        return data, True
+    wav_data, cached = generate_audio(text, speaker, sample_rate, requesters=requesters)
+    if not wav_data:
+        raise RuntimeError("tts generation failed")
+    with ENCODING_SECONDS.time(speaker=speaker_label(speaker), sample_rate=sample_rate, format=audio_format):
+        data = encode_audio(wav_data, audio_format)
+    audio_cache.put(key, data)
+    return data, cached
+
+# synthesize chunks concurrently on the chunk pool, results in input order
+def generate_chunks(chunks, speaker, sample_rate, requesters=()):
+    if len(chunks) == 1:
+        return [generate_sentence(chunks[0], speaker, sample_rate)]
+    return list(chunk_executor.map(
+        lambda chunk: generate_chunk(chunk, speaker, sample_rate, requesters), chunks
+    ))
+
+# a chunk waiting in the chunk pool is dropped when its requesters are gone
+def generate_chunk(chunk, speaker, sample_rate, requesters):
+    reason = abandoned_reason(requesters)
+    if reason:
+        DROPPED.inc(reason=reason)
+        raise DeadlineExceeded("nobody waits for the chunk any more")
+    return generate_sentence(chunk, speaker, sample_rate)
+
+# synthesize a single sentence or chunk through the cache
+def generate_sentence(text, speaker, sample_rate):
+    key = cache_key(text, speaker, sample_rate, Config.MODEL_VERSION)
+    cached = audio_cache.get(key)
+    CACHE_LOOKUPS.inc(speaker=speaker_label(speaker), sample_rate=sample_rate, result="hit" if cached else "miss")
     if cached:
         return cached, True
-    # generate new audio
+    # other rates are derived from the master sentence, never synthesized
+    derive = sample_rate != Config.MASTER_SAMPLE_RATE
     try:
-        path = tts_model.save_wav(
-            text=text,
-            speaker=speaker,
-            sample_rate=sample_rate
+        data, shared = synthesis_flights.do(
+            key, resample_sentence if derive else synthesize_sentence,
+            key, text, speaker, sample_rate
         )
-        with open(path, 'rb') as f:
-            data = f.read()
-        os.remove(path)
-        save_to_cache(text, data)
-        return data, False
     except Exception as e:
         logger.error(f"tts generation error: {e}")
         return None, False
+    if shared:
+        COALESCED.inc(speaker=speaker_label(speaker), sample_rate=sample_rate, format="wav")
+    return data, shared
+
+# resample the master sentence to sample_rate and cache the result as its
+# own variant, run once per key at a time
+def resample_sentence(key, text, speaker, sample_rate):
+    data = audio_cache.get(key) if audio_cache.contains(key) else None
+    if data:
+        return data
+    master, _ = generate_sentence(text, speaker, Config.MASTER_SAMPLE_RATE)
+    if not master:
+        raise RuntimeError("tts generation failed")
+    with RESAMPLING_SECONDS.time(speaker=speaker_label(speaker), sample_rate=sample_rate):
+        data = resample_wav(master, sample_rate)
+    audio_cache.put(key, data)
+    return data
+
+# synthesize and cache a sentence, run once per key at a time
+def synthesize_sentence(key, text, speaker, sample_rate):
+    # the previous flight for this key may have finished after our lookup
+    data = audio_cache.get(key) if audio_cache.contains(key) else None
+    if data:
+        return data
+    with SYNTHESIS_SECONDS.time(speaker=speaker_label(speaker), sample_rate=sample_rate):
+        data = synthesize_wav(text, speaker, sample_rate)
+    audio_cache.put(key, data)
+    return data
+
+# run the model and return wav bytes, bypassing the cache
+def synthesize_wav(text, speaker, sample_rate):
+    if replica_pool is not None:
+        return replica_pool.synthesize(text, speaker, sample_rate)
+    return synthesize_wav_local(text, speaker, sample_rate)
+
+# in-process synthesis. the waveform never touches the disk: it is
+# post-processed and converted straight into a wav buffer
+def synthesize_wav_local(text, speaker, sample_rate):
+    audio = tts_model.apply_tts(
+        text=text,
+        speaker=speaker,
+        sample_rate=sample_rate
+    )
+    if Config.POSTPROCESS:
+        audio = postprocess_audio(audio, sample_rate)
+    return pcm16_wav(audio, sample_rate)
+
+# trim leading and trailing silence, normalize loudness and fade the edges
+# of a float waveform. silence is judged on 10 ms frames against the peak,
+# so quiet and loud speakers are trimmed alike; the gain brings the rms of
+# the speech frames to TARGET_DBFS without letting the peak clip
+def postprocess_audio(audio, sample_rate):
+    if isinstance(audio, torch.Tensor):
+        audio = audio.detach().cpu().numpy()
+    samples = np.asarray(audio, dtype=np.float32).reshape(-1)
+    peak = float(np.max(np.abs(samples))) if samples.size else 0.0
+    if peak == 0.0:
+        return samples
+    frame = max(1, sample_rate // 100)
+    padded = np.pad(samples, (0, -samples.size % frame))
+    energy = np.sqrt(np.mean(np.square(padded.reshape(-1, frame)), axis=1))
+    speech = np.flatnonzero(energy > peak * 10 ** (Config.TRIM_THRESHOLD_DB / 20))
+    if not speech.size:
+        return samples
+    margin = int(sample_rate * Config.TRIM_MARGIN_MS / 1000)
+    start = max(0, speech[0] * frame - margin)
+    end = min(samples.size, (speech[-1] + 1) * frame + margin)
+    rms = float(np.sqrt(np.mean(np.square(energy[speech]))))
+    gain = min(10 ** (Config.TARGET_DBFS / 20) / rms, 0.99 / peak)
+    samples = samples[start:end] * np.float32(gain)
+    fade = min(int(sample_rate * Config.FADE_MS / 1000), samples.size // 2)
+    if fade:
+        ramp = np.linspace(0.0, 1.0, fade, dtype=np.float32)
+        samples[:fade] *= ramp
+        samples[-fade:] *= ramp[::-1]
+    return samples
+
+# replica worker process: pinned to its cores with one torch thread per core
+def _replica_init(cores, threads):
+    if hasattr(os, "sched_setaffinity"):
+        os.sched_setaffinity(0, cores)
+    # forked replicas share the parent's weights copy-on-write, spawned ones
+    # load their own copy
+    if tts_model is None:
+        load_tts_model()
+    torch.set_num_threads(threads)
+
+def _replica_ready():
+    return os.getpid()
+
+def _replica_synthesize(text, speaker, sample_rate):
+    return synthesize_wav_local(text, speaker, sample_rate)
+
+def available_cores():
+    if hasattr(os, "sched_getaffinity"):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(os.cpu_count() or 1))
+
+# n single-process pools, one model replica each, with requests dispatched to
+# the replica with the fewest requests in flight
+class ReplicaPool:
+    def __init__(self, count):
+        cores = available_cores()
+        per_replica = max(1, len(cores) // count)
+        # fork after the model is loaded so the weights are shared
+        # copy-on-write; platforms without fork load one copy per replica
+        method = "fork" if tts_model is not None and hasattr(os, "fork") else "spawn"
+        context = multiprocessing.get_context(method)
+        self.replicas = []
+        for index in range(count):
+            core_set = cores[index * per_replica:(index + 1) * per_replica] or cores
+            self.replicas.append(ProcessPoolExecutor(
+                1,
+                mp_context=context,
+                initializer=_replica_init,
+                initargs=(core_set, len(core_set))
+            ))
+        self.in_flight = [0] * count
+        self.lock = threading.Lock()
+        # start every process now, not lazily from a request thread
+        pids = [replica.submit(_replica_ready).result() for replica in self.replicas]
+        logger.info(f"{count} tts replicas started ({method}, {per_replica} cores each): {pids}")
+
+    def synthesize(self, text, speaker, sample_rate):
+        with self.lock:
+            index = self.in_flight.index(min(self.in_flight))
+            self.in_flight[index] += 1
+        try:
+            return self.replicas[index].submit(
+                _replica_synthesize, text, speaker, sample_rate
+            ).result()
+        finally:
+            with self.lock:
+                self.in_flight[index] -= 1
+
+    def shutdown(self):
+        for replica in self.replicas:
+            replica.shutdown(wait=False, cancel_futures=True)
+
+replica_pool = None
+
+def start_replicas(count):
+    global replica_pool
+    replica_pool = ReplicaPool(count)
+
+# model is usable in-process or through the replicas
+def model_ready():
+    return tts_model is not None or replica_pool is not None
+
+# canonical 44-byte header of a mono 16-bit pcm wav
+WAV_HEADER = struct.Struct('<4sI4s4sIHHIIHH4sI')
+
+def wav_header(num_samples, sample_rate):
+    data_size = num_samples * 2
+    return (
+        b'RIFF', 36 + data_size, b'WAVE', b'fmt ', 16, 1, 1,
+        sample_rate, sample_rate * 2, 2, 16, b'data', data_size
+    )
+
+# kaiser-windowed sinc kernel for resampling orig -> new (the rates divided
+# by their gcd), one row per output phase. same design as torchaudio's
+# sinc_interp_kaiser with its high quality settings
+@functools.lru_cache(maxsize=16)
+def resample_kernel(orig, new, lowpass_filter_width=64, rolloff=0.9475, beta=14.769656459379492):
+    base_freq = min(orig, new) * rolloff
+    width = math.ceil(lowpass_filter_width * orig / base_freq)
+    idx = torch.arange(-width, width + orig, dtype=torch.float64)[None, None] / orig
+    t = torch.arange(0, -new, -1, dtype=torch.float64)[:, None, None] / new + idx
+    t = (t * base_freq).clamp(-lowpass_filter_width, lowpass_filter_width)
+    window = torch.i0(beta * torch.sqrt(1 - (t / lowpass_filter_width) ** 2))
+    window /= torch.i0(torch.tensor(beta, dtype=torch.float64))
+    t = t * math.pi
+    kernel = torch.where(t == 0, torch.ones_like(t), torch.sin(t) / t)
+    return (kernel * window * base_freq / orig).to(torch.float32), width
+
+# band-limited resampling of a mono 16-bit wav: one strided convolution
+# yields every output phase at once
+def resample_wav(wav_data, sample_rate):
+    with wave.open(io.BytesIO(wav_data), 'rb') as f:
+        source_rate = f.getframerate()
+        pcm = np.frombuffer(f.readframes(f.getnframes()), dtype='<i2')
+    if source_rate == sample_rate:
+        return wav_data
+    gcd = math.gcd(source_rate, sample_rate)
+    orig, new = source_rate // gcd, sample_rate // gcd
+    kernel, width = resample_kernel(orig, new)
+    audio = torch.from_numpy(pcm.astype(np.float32) / 32768)[None, None]
+    with torch.no_grad():
+        padded = torch.nn.functional.pad(audio, (width, width + orig))
+        resampled = torch.nn.functional.conv1d(padded, kernel, stride=orig)
+    resampled = resampled.transpose(1, 2).reshape(-1)[:math.ceil(new * len(pcm) / orig)]
+    return pcm16_wav(resampled, sample_rate)
+
+# per-thread float scratch buffer reused across synthesis calls
+_scratch = threading.local()
+
+def scratch_buffer(size):
+    buffer = getattr(_scratch, 'buffer', None)
+    if buffer is None or len(buffer) < size:
+        buffer = np.empty(max(size, 1 << 20), dtype=np.float32)
+        _scratch.buffer = buffer
+    return buffer[:size]
+
+# float waveform in [-1, 1] -> wav bytes; samples are scaled in the scratch
+# buffer and written as int16 directly behind the header of the output
+def pcm16_wav(audio, sample_rate):
+    if isinstance(audio, torch.Tensor):
+        audio = audio.detach().cpu().numpy()
+    samples = np.asarray(audio, dtype=np.float32).reshape(-1)
+    buffer = bytearray(WAV_HEADER.size + samples.size * 2)
+    WAV_HEADER.pack_into(buffer, 0, *wav_header(samples.size, sample_rate))
+    pcm = np.frombuffer(buffer, dtype=np.int16, offset=WAV_HEADER.size)
+    scaled = scratch_buffer(samples.size)
+    np.multiply(samples, 32767, out=scaled)
+    np.clip(scaled, -32768, 32767, out=scaled)
+    pcm[:] = scaled
+    return bytes(buffer)
+
+# response formats of /conversation, json stays the default; any audio/*
+# type selects the raw audio body in the requested format
+AUDIO_MEDIA_TYPES = ("application/json", "audio/*", "multipart/mixed")
+
+# pick the response format with the highest q value from the accept header
+def negotiate_media_type(accept):
+    best, best_q = "application/json", 0.0
+    for part in accept.split(","):
+        media_type, _, params = part.partition(";")
+        media_type = media_type.strip().lower()
+        q = 1.0
+        for param in params.split(";"):
+            name, _, value = param.partition("=")
+            if name.strip() == "q":
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        if media_type.startswith("audio/"):
+            media_type = "audio/*"
+        if media_type in AUDIO_MEDIA_TYPES and q > best_q:
+            best, best_q = media_type, q
+    return best
+
+# text fields for binary responses, percent-encoded since headers are latin-1
+def conversation_headers(meta):
+    return {
+        "X-Sample-Rate": str(meta["sample_rate"]),
+        "X-User-Text": quote(meta["user_text"]),
+        "X-Bot-Response": quote(meta["bot_response"]),
+        "X-Is-Error": "true" if meta["is_error"] else "false",
+        "X-Message": meta["message"],
+        "Vary": "Accept",
+    }
+
+# json metadata part followed by the raw audio part
+def multipart_body(meta, audio_data):
+    boundary = uuid.uuid4().hex
+    body = b"".join([
+        f"--{boundary}\r\nContent-Type: application/json; charset=utf-8\r\n\r\n".encode(),
+        json.dumps(meta, ensure_ascii=False).encode('utf-8'),
+        f"\r\n--{boundary}\r\nContent-Type: {AUDIO_FORMATS[meta['format']][0]}\r\n"
+        f"Content-Length: {len(audio_data)}\r\n\r\n".encode(),
+        audio_data,
+        f"\r\n--{boundary}--\r\n".encode(),
+    ])
+    return body, f"multipart/mixed; boundary={boundary}"
+
+def sse_event(event, data):
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
 
+# synthesize a batch of (text, deadline, abandoned) jobs sharing speaker and
+# sample rate in one worker job; identical texts inside the batch are
+# synthesized only once, texts nobody waits for any more are skipped (None)
+def generate_audio_batch(jobs, speaker, sample_rate, audio_format="wav"):
+    waiting = {}
+    for text, deadline, abandoned in jobs:
+        waiting.setdefault(text, []).append((deadline, abandoned))
+    results = {}
+    for text, requesters in waiting.items():
+        reason = abandoned_reason(requesters)
+        if reason:
+            DROPPED.inc(reason=reason)
+            results[text] = None
+            continue
+        try:
+            results[text] = generate_audio(text, speaker, sample_rate, audio_format, requesters)
+        except DeadlineExceeded:
+            results[text] = None
+    return [results[text] for text, _, _ in jobs]
+
+# "cancelled" or "expired" once no requester waits for the work any more,
+# None while someone does (or nobody is tracked, e.g. prewarm)
+def abandoned_reason(requesters):
+    now = time.monotonic()
+    if not requesters or not all(
+        abandoned.is_set() or deadline < now for deadline, abandoned in requesters
+    ):
+        return None
+    if all(abandoned.is_set() for _, abandoned in requesters):
+        return "cancelled"
+    return "expired"
+
+# collects synthesis requests arriving within a short window and submits
+# them to the tts pool as one batch per (speaker, sample_rate, format)
+class BatchScheduler:
+    def __init__(self, executor, window, max_size):
+        self.executor = executor
+        self.window = window
+        self.max_size = max_size
+        self.pending = {}
+        self.timers = {}
+
+    async def submit(self, text, speaker, sample_rate, audio_format="wav", deadline=None):
+        loop = asyncio.get_running_loop()
+        key = (speaker, sample_rate, audio_format)
+        future = loop.create_future()
+        # tells the worker thread the caller stopped waiting
+        abandoned = threading.Event()
+        future.add_done_callback(lambda done: done.cancelled() and abandoned.set())
+        batch = self.pending.setdefault(key, [])
+        batch.append((text, future, math.inf if deadline is None else deadline, abandoned))
+        if len(batch) >= self.max_size:
+            self._flush(key)
+        elif len(batch) == 1:
+            self.timers[key] = loop.call_later(self.window, self._flush, key)
+        return await future
+
+    def _flush(self, key):
+        timer = self.timers.pop(key, None)
+        if timer:
+            timer.cancel()
+        batch = self.pending.pop(key, None)
+        if not batch:
+            return
+        # one job per worker keeps the pool busy in parallel; identical texts
+        # stay in the same job so they are still synthesized once
+        groups = {}
+        for item in batch:
+            groups.setdefault(item[0], []).append(item)
+        jobs = [[] for _ in range(min(self.executor.workers, len(groups)))]
+        for index, items in enumerate(groups.values()):
+            jobs[index % len(jobs)].extend(items)
+        for job in jobs:
+            self._submit(job, key)
+
+    def _submit(self, batch, key):
+        jobs = [(text, deadline, abandoned) for text, _, deadline, abandoned in batch]
+        deadlines = [deadline for _, _, deadline, _ in batch]
+        try:
+            job = self.executor.submit(
+                generate_audio_batch, jobs, *key,
+                deadline=max(deadlines), priority=min(deadlines)
+            )
+        except QueueFullError as e:
+            for _, future, _, _ in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        logger.debug(f"batch of {len(batch)} for {key}")
+        asyncio.wrap_future(job).add_done_callback(
+            lambda done: self._fan_out(batch, done)
+        )
+
+    def _fan_out(self, batch, done):
+        cancelled = done.cancelled()
+        error = None if cancelled else done.exception()
+        results = None if cancelled or error else done.result()
+        for index, (_, future, _, _) in enumerate(batch):
+            if future.done():
+                continue
+            if cancelled:
+                future.cancel()
+            elif error:
+                future.set_exception(error)
+            elif results[index] is None:
+                future.set_exception(DeadlineExceeded("deadline passed before synthesis"))
+            else:
+                future.set_result(results[index])
+
+batch_scheduler = BatchScheduler(
+    tts_executor,
+    Config.BATCH_WINDOW_MS / 1000,
+    Config.MAX_BATCH_SIZE
+)
+
+# synthesize text off the event loop, batched with concurrent requests.
+# deadline is the monotonic time after which the result is useless
+async def synthesize_audio(text, speaker, sample_rate, audio_format="wav", deadline=None):
+    check_deadline(deadline)
+    if Config.TTS_BATCHING:
+        return await batch_scheduler.submit(text, speaker, sample_rate, audio_format, deadline)
+    abandoned = threading.Event()
+    requesters = [(math.inf if deadline is None else deadline, abandoned)]
+    try:
+        return await tts_executor.run(
+            generate_audio, text, speaker, sample_rate, audio_format, requesters,
+            deadline=deadline
+        )
+    except asyncio.CancelledError:
+        abandoned.set()
+        raise
+
+def check_deadline(deadline):
+    if deadline is not None and time.monotonic() > deadline:
+        DROPPED.inc(reason="expired")
+        raise DeadlineExceeded("deadline passed before synthesis")
+
+# shared session reusing keep-alive connections across api calls
+api_session = None
+
+def create_api_session():
+    session = requests.Session()
+    adapter = HTTPAdapter(
+        pool_connections=Config.API_POOL_HOSTS,
+        pool_maxsize=Config.API_POOL_PER_HOST,
+        pool_block=True
+    )
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+# returns (answer, cacheable); the api opts an answer out of the answer
+# cache with Cache-Control: no-store / no-cache or "cacheable": false
 def call_external_api(text):
+    # outside the server lifespan (scripts, benchmarks) fall back to one-off requests
+    http = api_session or requests
     try:
-        resp = requests.get(
+        resp = http.get(
             Config.API_URL,
             params={'text': text, 'key': Config.API_KEY},
             timeout=Config.API_TIMEOUT
         )
         if resp.status_code == 200:
             data = resp.json()
-            return data.get('response') or data.get('text')
-        return None
+            control = resp.headers.get("Cache-Control", "").lower()
+            cacheable = (
+                data.get("cacheable", True) is not False
+                and "no-store" not in control and "no-cache" not in control
+            )
+            return data.get('response') or data.get('text'), cacheable
+        return None, False
     except Exception as e:
         logger.error(f"external api error: {e}")
-        return None
+        return None, False
+
+# punctuation and spaces around a question
+QUESTION_EDGE_RE = re.compile(r'^[\W_]+|[\W_]+$')
+
+# questions differing only in case, spacing or the punctuation around them
+# share an answer; symbols inside ("2+2" vs "2-2") stay part of the key
+def normalize_question(text):
+    text = " ".join(text.lower().replace("ё", "е").split())
+    return QUESTION_EDGE_RE.sub("", text)
+
+# lru memo of external api answers keyed by normalized question, entries
+# expire ttl seconds after the api returned them
+class AnswerCache:
+    def __init__(self, ttl, max_entries):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.entries = OrderedDict()  # question -> (answer, stored at)
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.entries)
+
+    @property
+    def enabled(self):
+        return self.ttl > 0 and self.max_entries > 0
+
+    # returns (answer, age); answer is None on a miss, age is set when the
+    # entry was found but had expired
+    def get(self, question):
+        with self.lock:
+            entry = self.entries.get(question)
+            if entry is None:
+                return None, None
+            answer, stored = entry
+            age = time.monotonic() - stored
+            if age > self.ttl:
+                del self.entries[question]
+                return None, age
+            self.entries.move_to_end(question)
+            return answer, age
+
+    def put(self, question, answer):
+        with self.lock:
+            self.entries[question] = (answer, time.monotonic())
+            self.entries.move_to_end(question)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+answer_cache = AnswerCache(Config.ANSWER_CACHE_TTL, Config.ANSWER_CACHE_SIZE)
+# the same question asked by several clients at once costs one api call
+answer_flights = SingleFlight()
+
+def cached_answer(question):
+    answer, age = answer_cache.get(question)
+    if answer is not None:
+        ANSWER_CACHE.inc(result="hit")
+        ANSWER_AGE.observe(age)
+        logger.info(f"answer cache hit ({age:.0f}s old): '{question[:50]}'")
+    elif age is not None:
+        ANSWER_CACHE.inc(result="expired")
+        logger.info(f"answer cache entry expired after {age:.0f}s: '{question[:50]}'")
+    else:
+        ANSWER_CACHE.inc(result="miss")
+    return answer
+
+# runs on an api worker: one call per question in flight, cacheable
+# answers are remembered when store is set
+def ask_external_api(text, question, store):
+    if not question:
+        return call_external_api(text)[0]
+    (answer, cacheable), shared = answer_flights.do(question, call_external_api, text)
+    if answer and not shared and store:
+        if cacheable:
+            answer_cache.put(question, answer)
+        else:
+            ANSWER_CACHE.inc(result="no_store")
+    return answer
 
 @app.get("/health")
 async def health():
     return {
         "status": "ok",
-        "model_loaded": tts_model is not None
+        "model_loaded": model_ready(),
+        "backend": Config.TTS_BACKEND,
+        "replicas": len(replica_pool.replicas) if replica_pool else 0,
+        "tts_pending": tts_executor.pending,
+        "tts_capacity": tts_executor.max_pending
     }
 
+# try to get response from external api (or the answer cache), echo user
+# text on failure.
+# while the api call is in flight the echo audio (echo_text) is synthesized
+# speculatively when a tts worker is idle, so the error path costs
+# max(api timeout, tts) instead of their sum. returns
+# (bot_text, is_error, echo_task); echo_task is None unless the echo is used
+async def get_bot_text(req, echo_text):
+    question = normalize_question(req.user_text)
+    use_cache = answer_cache.enabled and bool(question)
+    if use_cache and req.cache_answer:
+        answer = cached_answer(question)
+        if answer:
+            return answer, False, None
+    elif use_cache:
+        ANSWER_CACHE.inc(result="bypass")
+    api_call = asyncio.ensure_future(api_executor.run(
+        ask_external_api, req.user_text, question, use_cache and req.cache_answer,
+        deadline=req.deadline
+    ))
+    echo_task = None
+    if Config.SPECULATIVE_ECHO and tts_executor.has_idle_worker():
+        echo_task = asyncio.ensure_future(synthesize_audio(
+            echo_text,
+            req.speaker,
+            req.sample_rate,
+            req.format,
+            req.deadline
+        ))
+        # an unused speculative result is dropped without logging its errors
+        echo_task.add_done_callback(lambda task: task.cancelled() or task.exception())
+    start = time.perf_counter()
+    try:
+        api_response = await api_call
+    except BaseException:
+        if echo_task:
+            echo_task.cancel()
+        raise
+    API_SECONDS.observe(
+        time.perf_counter() - start,
+        speaker=speaker_label(req.speaker),
+        sample_rate=req.sample_rate,
+        result="ok" if api_response else "error"
+    )
+    if api_response:
+        if echo_task:
+            echo_task.cancel()
+        logger.info("external api success")
+        return api_response, False, None
+    # api failed - echo user text as error
+    logger.warning("external api failed - echoing text")
+    return req.user_text, True, echo_task
+
+@app.get("/cache/stats")
+async def cache_stats():
+    return audio_cache.stats()
+
+@app.get("/metrics")
+async def metrics_endpoint():
+    return Response(metrics.render(), media_type=METRICS_CONTENT_TYPE)
+
+def request_labels(endpoint, req):
+    return {"endpoint": endpoint, "speaker": speaker_label(req.speaker), "sample_rate": req.sample_rate}
+
 @app.post("/conversation", response_model=ConversationResponse)
-async def conversation(req: ConversationRequest):
-    if tts_model is None:
+async def conversation(req: ConversationRequest, request: Request):
+    labels = request_labels("conversation", req)
+    with REQUEST_SECONDS.time(**labels), IN_FLIGHT.track(**labels):
+        response = await until_disconnected(request, handle_conversation(req, request))
+    if time.monotonic() > req.deadline:
+        LATE.inc(endpoint="conversation")
+    return response
+
+# run the handler but cancel it when the client goes away, so its queued
+# synthesis is dropped instead of finished for nobody
+async def until_disconnected(request, handler):
+    task = asyncio.ensure_future(handler)
+    try:
+        while True:
+            done, _ = await asyncio.wait({task}, timeout=Config.DISCONNECT_POLL)
+            if done:
+                return task.result()
+            if await request.is_disconnected():
+                logger.info("client disconnected, dropping request")
+                DROPPED.inc(reason="disconnected")
+                task.cancel()
+                # nobody reads it, nginx's "client closed request"
+                return Response(status_code=499)
+    finally:
+        task.cancel()
+
+async def handle_conversation(req, request):
+    if not model_ready():
         raise HTTPException(503, "tts model not loaded")
     logger.info(f"processing: '{req.user_text[:30]}...'")
-    # try to get response from external api
-    api_response = call_external_api(req.user_text)
-    is_error = False
-    if api_response:
-        bot_text = api_response
-        logger.info("external api success")
-    else:
-        # api failed - echo user text as error
-        bot_text = req.user_text
-        is_error = True
-        logger.warning("external api failed - echoing text")
+    bot_text, is_error, echo_task = await get_bot_text(req, req.user_text)
+    meta = {
+        "sample_rate": req.sample_rate,
+        "user_text": req.user_text,
+        "bot_response": bot_text,
+        "is_error": is_error,
+        "message": "error echo" if is_error else "success",
+        "format": req.format,
+    }
+    media_type = negotiate_media_type(request.headers.get("accept", ""))
+    key = response_key(bot_text, req.speaker, req.sample_rate, req.format)
+    # a cached answer skips the tts queue and is sent without copying
+    response = await cached_response(key, meta, media_type)
+    if response is not None:
+        if echo_task:
+            echo_task.cancel()
+        return response
     # generate audio for response text
-    audio_data, cached = generate_audio(
-        bot_text,
-        req.speaker,
-        req.sample_rate
-    )
+    if echo_task:
+        audio_data, cached = await echo_task
+    else:
+        # only answers that need synthesis are refused when the queue is full
+        check_capacity()
+        audio_data, cached = await synthesize_audio(
+            bot_text,
+            req.speaker,
+            req.sample_rate,
+            req.format,
+            req.deadline
+        )
     if not audio_data:
         raise HTTPException(500, "tts generation failed")
-    return ConversationResponse(
-        audio_base64=base64.b64encode(audio_data).decode('utf-8'),
-        sample_rate=req.sample_rate,
-        user_text=req.user_text,
-        bot_response=bot_text,
-        is_error=is_error,
-        message="error echo" if is_error else "success"
+    if media_type == "audio/*":
+        return Response(
+            audio_data,
+            media_type=AUDIO_FORMATS[req.format][0],
+            headers=conversation_headers(meta)
+        )
+    if media_type == "multipart/mixed":
+        body, content_type = multipart_body(meta, audio_data)
+        return Response(body, media_type=content_type, headers={"Vary": "Accept"})
+    encoded = base64.b64encode(audio_data)
+    audio_cache.put_base64(key, encoded)
+    return Response(json_body(meta, encoded), media_type="application/json")
+
+# response for an answer already in the cache, None on a miss. files on
+# disk are streamed by FileResponse, json clients get the base64 form that
+# was encoded on an earlier request
+async def cached_response(key, meta, media_type):
+    if media_type == "application/json":
+        encoded = audio_cache.cached_base64(key)
+        if encoded is None and audio_cache.contains(key):
+            encoded = await asyncio.to_thread(audio_cache.base64, key)
+        if encoded is None:
+            return None
+        RESPONSE_HITS.inc(transport="base64")
+        return Response(json_body(meta, encoded), media_type="application/json")
+    if not audio_cache.contains(key):
+        return None
+    data, path = await asyncio.to_thread(audio_cache.locate, key)
+    if data is None and path is None:
+        return None
+    audio_type = AUDIO_FORMATS[meta["format"]][0]
+    RESPONSE_HITS.inc(transport="file" if path else "memory")
+    if media_type == "audio/*":
+        if path:
+            return FileResponse(path, media_type=audio_type, headers=conversation_headers(meta))
+        return Response(data, media_type=audio_type, headers=conversation_headers(meta))
+    if data is None:
+        data = await asyncio.to_thread(read_file, path)
+    body, content_type = multipart_body(meta, data)
+    return Response(body, media_type=content_type, headers={"Vary": "Accept"})
+
+def read_file(path):
+    with open(path, 'rb') as f:
+        return f.read()
+
+# ConversationResponse json around an already encoded audio_base64, so the
+# audio is neither re-encoded nor run through pydantic on every request
+def json_body(meta, encoded):
+    fields = json.dumps(meta, ensure_ascii=False, separators=(",", ":")).encode('utf-8')
+    return b'{"audio_base64":"' + encoded + b'",' + fields[1:]
+
+# streaming variant: synthesizes the response sentence by sentence and
+# pushes every chunk as a server-sent event as soon as it is ready
+@app.post("/conversation/stream")
+async def conversation_stream(req: ConversationRequest):
+    # request time and in-flight count run until the last event is sent
+    labels = request_labels("stream", req)
+    start = time.perf_counter()
+    IN_FLIGHT.inc(**labels)
+    done = []
+
+    # called when the stream ends and again as a background task, which also
+    # runs when the client went away before the stream started
+    def finished():
+        if done:
+            return
+        done.append(True)
+        IN_FLIGHT.dec(**labels)
+        REQUEST_SECONDS.observe(time.perf_counter() - start, **labels)
+
+    try:
+        return await handle_conversation_stream(req, finished)
+    except BaseException:
+        finished()
+        raise
+
+async def handle_conversation_stream(req, finished):
+    if not model_ready():
+        raise HTTPException(503, "tts model not loaded")
+    logger.info(f"streaming: '{req.user_text[:30]}...'")
+
+    async def events():
+        try:
+            async for event, data in conversation_events(req):
+                if event == "audio":
+                    data = dict(data)
+                    data["audio_base64"] = base64.b64encode(data.pop("audio")).decode('utf-8')
+                yield sse_event(event, data)
+        finally:
+            finished()
+
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+        background=BackgroundTask(finished)
     )
 
+# response of one request as (event, data) pairs, shared by the sse and
+# websocket channels: meta, audio per sentence (raw bytes under "audio"),
+# then done, or error on failure
+async def conversation_events(req):
+    # only the first echo sentence is speculated, it decides time-to-first-audio
+    user_sentences = split_sentences(req.user_text) or [req.user_text]
+    try:
+        bot_text, is_error, echo_task = await get_bot_text(req, user_sentences[0])
+    except QueueFullError:
+        yield "error", {"index": 0, "message": "server busy"}
+        return
+    except DeadlineExceeded:
+        yield "error", {"index": 0, "message": "deadline exceeded"}
+        return
+    sentences = user_sentences if is_error else split_sentences(bot_text) or [bot_text]
+    yield "meta", {
+        "sample_rate": req.sample_rate,
+        "user_text": req.user_text,
+        "bot_response": bot_text,
+        "is_error": is_error,
+        "chunks": len(sentences),
+        "format": req.format,
+    }
+    # the client waits up to req.wait for the first sentence and then for
+    # each next event, like a read timeout
+    deadline = req.deadline
+    for index, sentence in enumerate(sentences):
+        # cached sentences skip the batch scheduler and the tts queue
+        audio_data = await cached_sentence(
+            response_key(sentence, req.speaker, req.sample_rate, req.format), req
+        )
+        try:
+            if audio_data:
+                cached = True
+                if index == 0 and echo_task:
+                    echo_task.cancel()
+            elif index == 0 and echo_task:
+                audio_data, cached = await echo_task
+            else:
+                audio_data, cached = await synthesize_audio(
+                    sentence,
+                    req.speaker,
+                    req.sample_rate,
+                    req.format,
+                    deadline
+                )
+        except QueueFullError:
+            yield "error", {"index": index, "message": "server busy"}
+            return
+        except DeadlineExceeded:
+            yield "error", {"index": index, "message": "deadline exceeded"}
+            return
+        if not audio_data:
+            yield "error", {"index": index, "message": "tts generation failed"}
+            return
+        yield "audio", {
+            "index": index,
+            "text": sentence,
+            "cached": cached,
+            "audio": audio_data,
+        }
+        deadline = time.monotonic() + req.wait
+    yield "done", {
+        "chunks": len(sentences),
+        "message": "error echo" if is_error else "success"
+    }
+
+# audio of a sentence already in the cache, None on a miss
+async def cached_sentence(key, req):
+    if not audio_cache.contains(key):
+        return None
+    data = await asyncio.to_thread(audio_cache.get, key)
+    if data:
+        CACHE_LOOKUPS.inc(speaker=speaker_label(req.speaker), sample_rate=req.sample_rate, result="hit")
+    return data
+
+# request ids are chosen by the client: strings or numbers (or none for ping)
+def valid_request_id(request_id):
+    return request_id is None or (
+        isinstance(request_id, (str, int, float)) and not isinstance(request_id, bool)
+    )
+
+# persistent conversation channel over one websocket. json text messages:
+#   client -> server: request {id, user_text, speaker, sample_rate, format},
+#                     cancel {id}, ping, pong
+#   server -> client: progress {id, stage}, meta/done/error {id, ...},
+#                     audio {id, index, text, cached, size} followed by one
+#                     binary frame with the audio, cancelled {id}, ping, pong
+# several requests may be in flight at once, each tagged with its id
+class WebSocketSession:
+    def __init__(self, websocket):
+        self.websocket = websocket
+        self.tasks = {}
+        self.send_lock = asyncio.Lock()
+        self.last_seen = time.monotonic()
+
+    async def send(self, message, data=None):
+        # audio header and its binary frame must not interleave with others
+        async with self.send_lock:
+            await self.websocket.send_text(json.dumps(message, ensure_ascii=False))
+            if data is not None:
+                await self.websocket.send_bytes(data)
+
+    async def run(self):
+        heartbeat = asyncio.ensure_future(self.heartbeat())
+        try:
+            while True:
+                frame = await self.websocket.receive()
+                if frame["type"] == "websocket.disconnect":
+                    return
+                # the protocol is json objects in text frames only
+                message = json.loads(frame["text"]) if frame.get("text") is not None else None
+                if not isinstance(message, dict) or not valid_request_id(message.get("id")):
+                    await self.websocket.close(code=1003)
+                    return
+                self.last_seen = time.monotonic()
+                await self.dispatch(message)
+        except (WebSocketDisconnect, RuntimeError):
+            pass
+        except json.JSONDecodeError:
+            await self.websocket.close(code=1003)
+        finally:
+            heartbeat.cancel()
+            for task in self.tasks.values():
+                task.cancel()
+
+    async def dispatch(self, message):
+        kind = message.get("type")
+        request_id = message.get("id")
+        if kind == "ping":
+            await self.send({"type": "pong"})
+        elif kind == "request" and request_id is not None:
+            # an id stays taken until its request finishes, so cancel always
+            # reaches the request it was meant for
+            if request_id in self.tasks:
+                await self.send({"type": "error", "id": request_id, "message": "request id in use"})
+                return
+            task = asyncio.ensure_future(self.process(request_id, message))
+            self.tasks[request_id] = task
+            task.add_done_callback(lambda _: self.tasks.pop(request_id, None))
+        elif kind == "cancel":
+            task = self.tasks.get(request_id)
+            if task:
+                task.cancel()
+
+    async def process(self, request_id, message):
+        try:
+            req = ConversationRequest(**{
+                field: message[field]
+                for field in ConversationRequest.model_fields if field in message
+            })
+        except ValidationError as e:
+            await self.send({"type": "error", "id": request_id, "message": str(e)})
+            return
+        labels = request_labels("websocket", req)
+        try:
+            with REQUEST_SECONDS.time(**labels), IN_FLIGHT.track(**labels):
+                if not model_ready():
+                    await self.send({"type": "error", "id": request_id, "message": "tts model not loaded"})
+                    return
+                logger.info(f"websocket: '{req.user_text[:30]}...'")
+                await self.send({"type": "progress", "id": request_id, "stage": "api"})
+                async for event, data in conversation_events(req):
+                    if event == "audio":
+                        data = dict(data)
+                        audio_data = data.pop("audio")
+                        await self.send(
+                            {"type": "audio", "id": request_id, "size": len(audio_data), **data},
+                            audio_data
+                        )
+                        continue
+                    await self.send({"type": event, "id": request_id, **data})
+                    if event == "meta":
+                        await self.send({"type": "progress", "id": request_id, "stage": "synthesis"})
+        except asyncio.CancelledError:
+            logger.info(f"websocket request {request_id} cancelled")
+            try:
+                await self.send({"type": "cancelled", "id": request_id})
+            except Exception:
+                pass
+        except (WebSocketDisconnect, RuntimeError):
+            pass
+
+    # ping the client and drop connections that stopped answering
+    async def heartbeat(self):
+        while True:
+            await asyncio.sleep(Config.WS_HEARTBEAT)
+            if time.monotonic() - self.last_seen > Config.WS_HEARTBEAT * Config.WS_MISSED_HEARTBEATS:
+                logger.warning("websocket client missed heartbeats, closing")
+                await self.websocket.close(code=1001)
+                return
+            try:
+                await self.send({"type": "ping"})
+            except Exception:
+                return
+
+@app.websocket("/ws")
+async def conversation_ws(websocket: WebSocket):
+    await websocket.accept()
+    await WebSocketSession(websocket).run()
+
+# pre-warming worker process: loads its own model copy
+def _prewarm_init(threads):
+    load_tts_model()
+    torch.set_num_threads(threads)
+
+def _prewarm_synthesize(text, speaker, sample_rate):
+    return synthesize_wav_local(text, speaker, sample_rate)
+
+def read_phrases(path):
+    with open(path, encoding='utf-8') as f:
+        lines = (line.strip() for line in f)
+        return [line for line in lines if line and not line.startswith('#')]
+
+# synthesize every sentence of the phrase file for each configured speaker
+# and sample rate across a process pool. only this process writes to the
+# cache and every result is stored as it arrives, so an interrupted run
+# resumes where it stopped: entries already cached are skipped
+def prewarm(phrase_file, workers):
+    phrases = read_phrases(phrase_file)
+    jobs, checked, skipped = {}, set(), 0
+    for phrase in phrases:
+        chunks = [
+            chunk for sentence in split_sentences(phrase) or [phrase]
+            for chunk in split_chunks(sentence, Config.MAX_CHUNK_CHARS)
+        ]
+        # only the master rate is synthesized, other rates derive from it
+        for chunk in chunks:
+            for speaker in Config.PREWARM_SPEAKERS:
+                sample_rate = Config.MASTER_SAMPLE_RATE
+                key = cache_key(chunk, speaker, sample_rate, Config.MODEL_VERSION)
+                if key in checked:
+                    continue
+                checked.add(key)
+                if audio_cache.contains(key):
+                    skipped += 1
+                    continue
+                jobs[key] = (chunk, speaker, sample_rate)
+    total = len(jobs)
+    logger.info(f"prewarm: {len(phrases)} phrases, {total} sentences to synthesize, "
+                f"{skipped} already cached, {workers} workers")
+    start = time.time()
+    failed = 0
+    if jobs:
+        threads = max(1, (os.cpu_count() or 1) // workers)
+        with ProcessPoolExecutor(workers, initializer=_prewarm_init, initargs=(threads,)) as pool:
+            futures = {pool.submit(_prewarm_synthesize, *job): key for key, job in jobs.items()}
+            for done, future in enumerate(as_completed(futures), 1):
+                try:
+                    audio_cache.put(futures[future], future.result())
+                except Exception as e:
+                    failed += 1
+                    logger.error(f"prewarm error: {e}")
+                if done % 10 == 0 or done == total:
+                    logger.info(f"prewarm: {done}/{total} ({time.time() - start:.1f}s)")
+    # resampled and encoded variants are built from the cached sentences in
+    # this process
+    derived = 0
+    for audio_format in Config.PREWARM_FORMATS:
+        for phrase in phrases:
+            for speaker in Config.PREWARM_SPEAKERS:
+                for sample_rate in Config.PREWARM_SAMPLE_RATES:
+                    if audio_format == "opus" and sample_rate not in OPUS_SAMPLE_RATES:
+                        continue
+                    # a variant counts when it was missing before, even if
+                    # it was built from cached sentences
+                    existed = audio_cache.contains(
+                        response_key(phrase, speaker, sample_rate, audio_format)
+                    )
+                    data, _ = generate_audio(phrase, speaker, sample_rate, audio_format)
+                    derived += bool(data) and not existed
+    logger.info(f"prewarm finished in {time.time() - start:.1f}s: {total - failed} synthesized, "
+                f"{skipped} skipped, {failed} failed, {derived} derived variants")
+
 if __name__ == "__main__":
+    import argparse
     import uvicorn
-    load_tts_model()
-    uvicorn.run(app, host="0.0.0.0", port=8000)
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="silero tts server")
+    parser.add_argument("--prewarm", metavar="FILE",
+                        help="synthesize the phrases in FILE into the cache before serving")
+    parser.add_argument("--prewarm-workers", type=int, default=max(1, (os.cpu_count() or 1) // 4),
+                        help="model processes used for pre-warming")
+    parser.add_argument("--prewarm-only", action="store_true",
+                        help="exit after pre-warming instead of starting the server")
+    args = parser.parse_args()
+    if args.prewarm:
+        try:
+            prewarm(args.prewarm, args.prewarm_workers)
+        except BaseException:
+            # keep the results still queued for the disk, e.g. on ctrl-c
+            audio_cache.close()
+            raise
+    if args.prewarm_only:
+        audio_cache.close()
+    else:
+        # spawned replicas load their own models, the server needs none
+        if not Config.TTS_REPLICAS or hasattr(os, "fork"):
+            load_tts_model()
+        if Config.TTS_REPLICAS:
+            start_replicas(Config.TTS_REPLICAS)
+        uvicorn.run(app, host="0.0.0.0", port=8000)
\ No newline at end of file
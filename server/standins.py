@@ -0,0 +1,92 @@
+import json
+import math
+import random
+import threading
+import time
+import wave
+import zlib
+import torch
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+# deterministic stand-in for the silero model, used by benchmarks and
+# offline tests when model.pt is not available. it mimics the apply_tts /
+# save_wav interface and simulates synthesis cost with a fixed per-call
+# overhead plus a per-character cost, either sleeping or (busy=True)
+# keeping a core busy like real inference does
+class StandInTTSModel:
+    def __init__(self, overhead=0.05, per_char=0.002, seconds_per_char=0.06, busy=False):
+        self.overhead = overhead
+        self.per_char = per_char
+        self.seconds_per_char = seconds_per_char
+        self.busy = busy
+
+    def _spend(self, seconds):
+        if not self.busy:
+            time.sleep(seconds)
+            return
+        deadline = time.perf_counter() + seconds
+        while time.perf_counter() < deadline:
+            pass
+
+    def to(self, device):
+        return self
+
+    def apply_tts(self, text, speaker="baya", sample_rate=48000, **kwargs):
+        self._spend(self.overhead + self.per_char * len(text))
+        samples = max(1, int(len(text) * self.seconds_per_char * sample_rate))
+        # every speaker gets its own tone so outputs differ per speaker
+        frequency = 180 + zlib.crc32(speaker.encode('utf-8')) % 120
+        t = torch.arange(samples, dtype=torch.float32) / sample_rate
+        return 0.3 * torch.sin(2 * math.pi * frequency * t)
+
+    def save_wav(self, text, speaker="baya", sample_rate=48000,
+                 audio_path="test.wav", **kwargs):
+        audio = self.apply_tts(text, speaker=speaker, sample_rate=sample_rate)
+        pcm = (audio * 32767).to(torch.int16).numpy().tobytes()
+        with wave.open(audio_path, 'wb') as f:
+            f.setnchannels(1)
+            f.setsampwidth(2)
+            f.setframerate(sample_rate)
+            f.writeframes(pcm)
+        return audio_path
+
+# stand-in for the external conversation api: answers GET /ask?text=...
+# with {"response": ...} after a fixed latency, failing with 500 at the
+# configured rate. speaks http/1.1 so clients can keep connections alive
+class StandInAPIHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # headers and body go out in separate writes; with nagle on, kept-alive
+    # connections stall on delayed acks
+    disable_nagle_algorithm = True
+    latency = 0.0
+    failure_rate = 0.0
+
+    def do_GET(self):
+        query = parse_qs(urlparse(self.path).query)
+        text = query.get("text", [""])[0]
+        time.sleep(self.latency)
+        if random.random() < self.failure_rate:
+            status, body = 500, {"error": "stand-in failure"}
+        else:
+            status, body = 200, {"response": f"Вы сказали: {text}"}
+        payload = json.dumps(body, ensure_ascii=False).encode('utf-8')
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, format, *args):
+        pass
+
+# run the stand-in api in a background thread, returns (server, url)
+def start_standin_api(port=0, latency=0.0, failure_rate=0.0):
+    handler = type("Handler", (StandInAPIHandler,), {
+        "latency": latency,
+        "failure_rate": failure_rate,
+    })
+    server = ThreadingHTTPServer(("127.0.0.1", port), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_address[1]}/ask"
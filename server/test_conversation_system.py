@@ -1,6 +1,8 @@
 import requests
 import time
+import json
 import sys
+from urllib.parse import unquote
 
 SERVER_URL = "http://192.168.137.1:8000"
 
@@ -129,6 +131,72 @@ def test_long_text():
         print_test("Long Text Handling", False, str(e))
         return False
 
+# Test 6: Streaming endpoint delivers the first chunk before the last
+def test_streaming_endpoint():
+    try:
+        text = "Первое предложение. Второе предложение! Третье предложение?"
+        start = time.time()
+        response = requests.post(
+            f"{SERVER_URL}/conversation/stream",
+            json={"user_text": text, "speaker": "baya"},
+            timeout=60,
+            stream=True
+        )
+        events = []
+        first_audio_at = None
+        event = None
+        for line in response.iter_lines(decode_unicode=True):
+            if line.startswith("event:"):
+                event = line[6:].strip()
+            elif line.startswith("data:"):
+                events.append((event, json.loads(line[5:])))
+                if event == "audio" and first_audio_at is None:
+                    first_audio_at = time.time() - start
+        total = time.time() - start
+        names = [name for name, _ in events]
+        audio = [data for name, data in events if name == "audio"]
+        passed = (
+            response.status_code == 200 and
+            names[:1] == ["meta"] and
+            names[-1:] == ["done"] and
+            len(audio) == events[0][1].get('chunks') and
+            all(len(data.get('audio_base64', '')) > 1000 for data in audio)
+        )
+        message = f"Chunks: {len(audio)}, first audio: {first_audio_at or 0:.2f}s, total: {total:.2f}s"
+        print_test("Streaming Endpoint", passed, message)
+        return passed
+    except Exception as e:
+        print_test("Streaming Endpoint", False, str(e))
+        return False
+
+# Test 7: Binary transport returns raw wav with text fields in headers
+def test_binary_transport():
+    try:
+        response = requests.post(
+            f"{SERVER_URL}/conversation",
+            json={"user_text": "Тест бинарного ответа", "speaker": "baya"},
+            headers={"Accept": "audio/wav"},
+            timeout=30
+        )
+        json_response = requests.post(
+            f"{SERVER_URL}/conversation",
+            json={"user_text": "Тест бинарного ответа", "speaker": "baya"},
+            timeout=30
+        )
+        bot_response = unquote(response.headers.get('X-Bot-Response', ''))
+        passed = (
+            response.status_code == 200 and
+            response.headers.get('Content-Type', '').startswith('audio/wav') and
+            response.content[:4] == b'RIFF' and
+            bot_response == json_response.json().get('bot_response')
+        )
+        message = f"Binary: {len(response.content)} bytes, JSON: {len(json_response.content)} bytes"
+        print_test("Binary Transport", passed, message)
+        return passed
+    except Exception as e:
+        print_test("Binary Transport", False, str(e))
+        return False
+
 # Run all tests
 def run_all_tests():
     print(f"\n{Colors.BLUE}{'='*60}{Colors.END}")
@@ -142,6 +210,8 @@ def run_all_tests():
         ("Error Echo", test_error_echo),
         ("Cache", test_cache_functionality),
         ("Long Text", test_long_text),
+        ("Streaming", test_streaming_endpoint),
+        ("Binary Transport", test_binary_transport),
     ]
     
     results = []
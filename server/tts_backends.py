@@ -0,0 +1,65 @@
+import os
+import logging
+import torch
+from standins import StandInTTSModel
+
+logger = logging.getLogger(__name__)
+
+# synthesis backends selectable with TTS_BACKEND. a backend is a loader
+# returning an object with apply_tts(text, speaker, sample_rate) -> float
+# waveform tensor; everything above it (caching, encoding, replicas) is
+# backend-agnostic
+BACKENDS = {}
+
+def backend(name):
+    def register(loader):
+        BACKENDS[name] = loader
+        return loader
+    return register
+
+def load_backend(name, **options):
+    if name not in BACKENDS:
+        raise ValueError(f"unknown tts backend '{name}', available: {', '.join(sorted(BACKENDS))}")
+    return BACKENDS[name](**options)
+
+# silero v4 from its torch.package, downloaded on first use
+@backend("silero")
+def load_silero(model_file="model.pt", model_url=None, **options):
+    if not os.path.isfile(model_file):
+        logger.info("downloading silero model...")
+        torch.hub.download_url_to_file(model_url, model_file)
+    model = torch.package.PackageImporter(model_file).load_pickle("tts_models", "model")
+    model.to(torch.device('cpu'))
+    return model
+
+# silero with the linear layers of its network dynamically quantized to
+# int8: weights are stored as int8, activations are quantized on the fly.
+# the network inside the package is torchscript, which needs the jit
+# variant of dynamic quantization
+@backend("silero-int8")
+def load_silero_int8(**options):
+    model = load_silero(**options)
+    engines = torch.backends.quantized.supported_engines
+    # fbgemm on x86, qnnpack on arm
+    for engine in ("x86", "fbgemm", "qnnpack"):
+        if engine in engines:
+            torch.backends.quantized.engine = engine
+            break
+    network = getattr(model, "model", None)
+    if not isinstance(network, torch.nn.Module):
+        raise ValueError("silero package has no quantizable network")
+    network.eval()
+    if isinstance(network, torch.jit.ScriptModule):
+        from torch.ao.quantization import quantize_dynamic_jit, default_dynamic_qconfig
+        model.model = quantize_dynamic_jit(network, {"": default_dynamic_qconfig})
+    else:
+        model.model = torch.ao.quantization.quantize_dynamic(
+            network, {torch.nn.Linear}, dtype=torch.qint8
+        )
+    logger.info(f"silero quantized to int8 ({torch.backends.quantized.engine})")
+    return model
+
+# deterministic tone generator for offline tests and benchmarks
+@backend("standin")
+def load_standin(**options):
+    return StandInTTSModel()